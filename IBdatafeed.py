@@ -4,7 +4,6 @@ from ibapi.contract import Contract
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
 import threading
-import time
 import pandas as pd
 
 class IBdatafeed(EClient, EWrapper):
@@ -15,6 +14,12 @@ class IBdatafeed(EClient, EWrapper):
         EWrapper.__init__(self)
         EClient.__init__(self, self)
         self.data = {'reqId': None, 'Date': [], 'Open': [], 'High': [], 'Low': [], 'Close': [], 'Volume': []}
+        self.history_done = threading.Event()
+        # Callbacks set by liveengine.ib_broker, called on the ibapi reader thread
+        self.on_next_valid_id = None
+        self.on_realtime_bar = None
+        self.on_order_status = None
+        self.on_connection_closed = None
 
     def error(self, reqId, errorCode, errorString):
         print(f"Error {reqId}: {errorCode} - {errorString}")
@@ -28,14 +33,17 @@ class IBdatafeed(EClient, EWrapper):
         contract.currency = 'USD'
         return contract
 
-    def get_historical_dataframe(self, reqId, contract, duration, intervals):
+    def get_historical_dataframe(self, reqId, contract, duration, intervals, timeout=30):
         self.data['reqId'] = reqId
+        self.history_done.clear()
         print("Requesting historical data...")
         self.reqHistoricalData(reqId=reqId, contract=contract, endDateTime="",
                                durationStr=duration, barSizeSetting=intervals, whatToShow='MIDPOINT',
                                useRTH=1, formatDate=1, keepUpToDate=False, chartOptions=[])
-        time.sleep(3)  # Adjust this as necessary
         print("Data request sent. Waiting for response...")
+        # Returns as soon as historicalDataEnd arrives rather than after a fixed sleep
+        if not self.history_done.wait(timeout):
+            print("Historical data request %s timed out" % reqId)
         return pd.DataFrame(self.data)
 
     def historicalData(self, reqId: int, bar: BarData):
@@ -48,16 +56,37 @@ class IBdatafeed(EClient, EWrapper):
         self.data['Close'].append(bar.close)
         self.data['Volume'].append(bar.volume)
 
+    def historicalDataEnd(self, reqId: int, start: str, end: str):
+        self.history_done.set()
 
-    def background_connection_thread(self):
-        self.connect("127.0.0.1", 7497, clientId=10)
+    def nextValidId(self, orderId: int):
+        if self.on_next_valid_id is not None:
+            self.on_next_valid_id(orderId)
+
+    def realtimeBar(self, reqId, time, open_, high, low, close, volume, wap, count):
+        if self.on_realtime_bar is not None:
+            self.on_realtime_bar(reqId, time, open_, high, low, close, volume)
+
+    def orderStatus(self, orderId, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice,
+                    clientId, whyHeld, mktCapPrice):
+        if self.on_order_status is not None:
+            self.on_order_status(orderId, status, filled, avgFillPrice)
+
+    def connectionClosed(self):
+        if self.on_connection_closed is not None:
+            self.on_connection_closed()
+
+    def background_connection_thread(self, host="127.0.0.1", port=7497, client_id=10):
+        self.connect(host, port, clientId=client_id)
         api_thread = threading.Thread(target=self.run, daemon=True)
         api_thread.start()
 
-app = IBdatafeed()
-app.background_connection_thread()
-contract = app.create_contract('AAPL', 'STK')
-df = app.get_historical_dataframe(1, contract, '1 D', '1 hour')
-app.historicalData(1, BarData())
-print(df)
+
+if __name__ == "__main__":
+    app = IBdatafeed()
+    app.background_connection_thread()
+    contract = app.create_contract('AAPL', 'STK')
+    df = app.get_historical_dataframe(1, contract, '1 D', '1 hour')
+    app.historicalData(1, BarData())
+    print(df)
 
@@ -1,11 +1,11 @@
 import datetime
-import time
 import ibapi
 from ibapi.connection import Connection
 from ibapi.contract import Contract
 from ibapi.order import Order
 from ibapi.message import IN, OUT
-from execution import ExecutionHandler
+from executionhandler import ExecutionHandler
+from dataeventhandler import fill_event
 
 
 class IBExecutionHandler(ExecutionHandler):
@@ -39,7 +39,7 @@ class IBExecutionHandler(ExecutionHandler):
         Handles of server replies
         """
         # Handle open order orderId processing
-        if msg.typeName == "openOrder" and msg.orderId == self.order_id and not self.fill_dict.has_key(msg.orderId):
+        if msg.typeName == "openOrder" and msg.orderId == self.order_id and msg.orderId not in self.fill_dict:
             self.create_fill_dict_entry(msg)
         # Handle Fills
         if msg.typeName == "orderStatus" and msg.status == "Filled" and self.fill_dict[msg.orderId]["filled"] == False:
@@ -138,7 +138,7 @@ class IBExecutionHandler(ExecutionHandler):
         # Make sure that multiple messages don’t create additional fills.
         self.fill_dict[msg.orderId]["filled"] = True
         # Place the fill event onto the event queue
-        self.events.put(fill_event)
+        self.events.put(fill)
 
     def execute_order(self, event):
         """
@@ -162,10 +162,8 @@ class IBExecutionHandler(ExecutionHandler):
             # Create the Interactive Brokers order via the passed Order event
             ib_order = self.create_order(order_type, quantity, direction)
             # Use the connection to the send the order to IB
+            # The fill arrives later through reply_handler, so there is no need to wait here
             self.tws_conn.placeOrder(self.order_id, ib_contract, ib_order)
-            # NOTE: This following line is crucial.
-            # It ensures the order goes through!
-            time.sleep(1)
             # Increment the order ID for this session
             self.order_id += 1
 
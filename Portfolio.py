@@ -5,7 +5,7 @@ import numpy as np
 import pandas as pd
 from dataeventhandler import event
 from dataeventhandler import order_event
-from sharpe import calculate_sharpe, calculate_drawdowns
+import performance
 
 
 class portfolio(object):
@@ -13,14 +13,26 @@ class portfolio(object):
     The Portfolio class handles the positions and market
     value of all instruments at a resolution of a "bar",
     i.e. secondly, minutely, 5-min, 30-min, 60 min or EOD.
-    The positions DataFrame stores a time-index of the
+    The positions matrix stores a time-index of the
     quantity of positions held.
-    The holdings DataFrame stores the cash and total market
+    The holdings matrix stores the cash and total market
     holdings value of each symbol for a particular
     time-index, as well as the percentage change in
     portfolio total across bars.
+    Both are preallocated (bars x symbols) NumPy matrices, doubled
+    when full, filled one row per bar with a vectorized mark-to-market,
+    and read through DataFrames viewing them without copying. The returns
+    and equity curve are kept up to date in the same way, and the equity
+    curve DataFrame is only rebuilt once new bars have been recorded.
     """
 
+    # The naive number of units bought or sold on an entry signal
+    order_quantity = 100
+    # The number of bars the history matrices are first allocated for
+    initial_capacity = 1024
+    # The number of bars in a year, minute bars by default
+    periods_per_year = 252 * 60 * 6.5
+
     def __init__(self, bars, event, start_date, symbols, initial_capital=100000):
         """
         Initialises the portfolio with bars and an event queue.
@@ -36,19 +48,28 @@ class portfolio(object):
         self.initial_capital = initial_capital
         self.symbols = symbols
         self.event = event
-        self.positions = self.construct_all_positions()
-        self.current_positions = {symbol: 0 for symbol in self.symbols}
+        self.symbol_index = {symbol: j for j, symbol in enumerate(self.symbols)}
+        # The holdings columns, the value of each symbol then commission, cash and total,
+        # followed in the history matrix by the returns and equity curve
+        self.columns = list(self.symbols) + ['commission', 'cash', 'total']
+        self.curve_columns = self.columns + ['returns', 'equity_curve']
+        self.curve_cache = None
+        self.construct_all_positions()
+        self.construct_all_holdings()
+        self.current_positions = np.zeros(len(self.symbols))
         self.current_holdings = self.construct_current_holdings()
-        self.holdings = self.construct_all_holdings()
+        self.online = performance.online_performance(self.periods_per_year)
         self.equity_curve = self.create_equity_curve_dataframe()
 
     def construct_all_positions(self):
         """
-        returns a dictionary with the date and position
+        Allocates the dates and positions matrix, whose first
+        row holds no position at the start date
         """
-        position = {symbol: 0 for symbol in self.symbols}
-        position['datetime'] = self.start_date
-        return [position]
+        self.dates = np.empty(self.initial_capacity, dtype='datetime64[ns]')
+        self.dates[0] = pd.Timestamp(self.start_date).to_datetime64()
+        self.position_history = np.zeros((self.initial_capacity, len(self.symbols)))
+        self.n = 1
 
     def construct_current_holdings(self):
         """"
@@ -65,16 +86,44 @@ class portfolio(object):
 
     def construct_all_holdings(self):
         """"
-        returns a dictionary containing symbol, date, commission, capital and Total
+        Allocates the holdings matrix, whose first row holds the
+        initial capital in cash at the start date
         """
-        holding = {}
-        for symbol in self.symbols:
-            holding[symbol] = 0
-        holding['datetime'] = self.start_date
-        holding['commission'] = 0
-        holding['cash'] = self.initial_capital
-        holding['total'] = self.initial_capital
-        return [holding]
+        self.holding_history = np.zeros((self.initial_capacity, len(self.curve_columns)))
+        self.holding_history[0, -4:-2] = self.initial_capital
+        self.holding_history[0, -2:] = np.nan
+        # The compounded growth of the equity curve, over the returns that are not NaN
+        self.growth = 1.0
+        # The absolute value traded between two bars, for turnover
+        self.traded_history = np.zeros(self.initial_capacity)
+        self.traded = 0.0
+
+    def grow(self):
+        """
+        Doubles the number of bars the history matrices can hold.
+        """
+        capacity = 2 * len(self.dates)
+        for name in ('dates', 'position_history', 'holding_history', 'traded_history'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    @property
+    def positions(self):
+        """
+        The positions held on every bar so far, as a DataFrame viewing the positions matrix.
+        """
+        return pd.DataFrame(self.position_history[:self.n], index=pd.Index(self.dates[:self.n], name='datetime'),
+                            columns=self.symbols, copy=False)
+
+    @property
+    def holdings(self):
+        """
+        The holdings of every bar so far, as a DataFrame viewing the holdings matrix.
+        """
+        return pd.DataFrame(self.holding_history[:self.n, :len(self.columns)],
+                            index=pd.Index(self.dates[:self.n], name='datetime'), columns=self.columns, copy=False)
 
     def update_time(self, event):
         """
@@ -83,26 +132,35 @@ class portfolio(object):
         current market data at this stage is known (OHLCV).
         Makes use of a MarketEvent from the events queue. Updates positions and holdings
         """
-        latest_datetime = self.bars.get_latest_bars_datetime(1)
+        prices = self.bars.get_latest_bar_values()
+        if self.n == len(self.dates):
+            self.grow()
+        i = self.n
+        self.dates[i] = self.bars.get_latest_bars_datetime(1)[-1]
         # Update positions
-        dp = {}
-        for symbol in self.symbols:
-            dp[symbol] = self.current_positions[symbol]
-        dp['datetime'] = latest_datetime
-        self.positions.append(dp)
-        # Update holdings
-        dh = {}
-        for symbol in self.symbols:
-            dh[symbol] = 0
-        dh['datetime'] = latest_datetime
-        dh['cash'] = self.current_holdings['cash']
-        dh['commission'] = self.current_holdings['commission']
-        dh['total'] = self.current_holdings['cash']
-        for symbol in self.symbols:
-            market_value = self.current_positions[symbol]*self.bars.get_latest_bar_value(symbol)
-            dh[symbol] = market_value
-            dh['total']+=market_value
-        self.holdings.append(dh)
+        self.position_history[i] = self.current_positions
+        # Update holdings, marking every position to market at once
+        row = self.holding_history[i]
+        values = row[:len(self.symbols)]
+        np.multiply(self.current_positions, prices, out=values)
+        cash = self.current_holdings['cash']
+        row[-5] = self.current_holdings['commission']
+        row[-4] = cash
+        row[-3] = cash + values.sum()
+        # Returns follow the cash, as pct_change does, and the equity curve
+        # compounds them, skipping NaN returns as cumprod does
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = np.float64(cash) / self.holding_history[i - 1, -4] - 1.0
+        row[-2] = returns
+        if returns == returns:
+            self.growth *= 1.0 + returns
+            row[-1] = self.growth
+        else:
+            row[-1] = np.nan
+        self.traded_history[i] = self.traded
+        self.traded = 0.0
+        self.online.update(returns, row[-1], np.abs(values).sum(), row[-3])
+        self.n += 1
 
     def update_positions_from_fill(self, fill):
         """
@@ -116,7 +174,7 @@ class portfolio(object):
         if fill.direction == 'SELL':
             fill_dir = -1
         # Update positions list with new quantities
-        self.current_positions[fill.symbol] += fill_dir * fill.quantity
+        self.current_positions[self.symbol_index[fill.symbol]] += fill_dir * fill.quantity
 
     def update_holdings_from_fill(self, fill):
         """
@@ -130,8 +188,9 @@ class portfolio(object):
         if fill.direction == 'SELL':
             fill_dir = -1
     # Update holdings dict with new quantities
-        fill_cost = self.bars.get_latest_bar_value(fill.symbol)
+        fill_cost = self.bars.get_latest_bar_values()[self.symbol_index[fill.symbol]]
         cost = fill_dir * fill_cost * fill.quantity
+        self.traded += abs(cost)
         self.current_holdings[fill.symbol] += cost
         self.current_holdings['commission'] += fill.commission
         self.current_holdings['cash'] -= (cost + fill.commission)
@@ -145,6 +204,7 @@ class portfolio(object):
         if event.type == 'FILL':
             self.update_positions_from_fill(event)
             self.update_holdings_from_fill(event)
+            self.online.record_fill(event)
 
     def generate_market_order(self, signal):
         """
@@ -153,8 +213,8 @@ class portfolio(object):
         symbol = signal.symbol
         direction = signal.signal_type
         strength = signal.strength
-        mkt_quantity = 100
-        cur_quantity = self.current_positions[symbol]
+        mkt_quantity = self.order_quantity
+        cur_quantity = int(self.current_positions[self.symbol_index[symbol]])
         order = None
         order_type = 'MKT'
         if direction == 'LONG' and cur_quantity == 0:
@@ -174,32 +234,41 @@ class portfolio(object):
         """
         if event.type == 'SIGNAL':
             order_event = self.generate_market_order(event)
-            self.event.put(order_event)
+            if order_event is not None:
+                self.event.put(order_event)
 
     def create_equity_curve_dataframe(self):
         """
-        Creates a pandas DataFrame from the all_holdings
-        list of dictionaries.
+        Returns a pandas DataFrame viewing the holdings matrix, with the
+        returns and equity curve. It is cached until the next bar is recorded.
+        """
+        if self.curve_cache is None or self.curve_cache[0] != self.n:
+            curve = pd.DataFrame(self.holding_history[:self.n], index=pd.Index(self.dates[:self.n], name='datetime'),
+                                 columns=self.curve_columns, copy=False)
+            self.curve_cache = (self.n, curve)
+        return self.curve_cache[1]
+
+    def summary_stats(self):
+        """
+        Returns the summary statistics of the portfolio as a dictionary
+        of numbers, see performance.performance_summary.
         """
-        curve = pd.DataFrame(self.holdings)
-        curve.set_index('datetime', inplace = True)
-        curve['returns'] = curve['cash'].pct_change()
-        curve['equity_curve'] = (1.0 + curve['returns']).cumprod()
-        return curve
+        curve = self.create_equity_curve_dataframe()
+        return performance.performance_summary(curve['returns'].values, self.traded_history[:self.n],
+                                               curve['total'].values, self.periods_per_year)
 
     def output_summary_stats(self):
         """
-        Creates a list of summary statistics for the portfolio.
-        """
-        total_return = self.create_equity_curve_dataframe()['equity_curve'][-1]
-        returns = self.create_equity_curve_dataframe()['returns']
-        pnl = self.create_equity_curve_dataframe()['equity_curve']
-        sharpe_ratio = calculate_sharpe(returns, 252 * 60 * 6.5)
-        # drawdown, max_dd, dd_duration = calculate_drawdowns(pnl)
-        # self.create_equity_curve_dataframe()['drawdown'] = drawdown
-        stats = [("Total Return", "%0.2f%%" % ((total_return - 1.0) * 100.0)),
-                 ("Sharpe Ratio", "%0.2f" % sharpe_ratio)]
-                 # ("Max Drawdown", "%0.2f%%" % (max_dd * 100.0)),
-                 # ("Drawdown Duration", "%s" % dd_duration)]
+        Creates a list of summary statistics for the portfolio, formatted for display.
+        """
+        summary = self.summary_stats()
+        stats = [("Total Return", "%0.2f%%" % (summary['total_return'] * 100.0)),
+                 ("Sharpe Ratio", "%0.2f" % summary['sharpe']),
+                 ("Sortino Ratio", "%0.2f" % summary['sortino']),
+                 ("Calmar Ratio", "%0.2f" % summary['calmar']),
+                 ("Max Drawdown", "%0.2f%%" % (summary['max_drawdown'] * 100.0)),
+                 ("Drawdown Duration", "%s" % summary['max_drawdown_duration']),
+                 ("VaR 95%", "%0.2f%%" % (summary['var'] * 100.0)),
+                 ("CVaR 95%", "%0.2f%%" % (summary['cvar'] * 100.0)),
+                 ("Turnover", "%0.2f" % summary['turnover'])]
         return stats
-
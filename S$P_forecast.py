@@ -1,15 +1,14 @@
 import datetime
 from datetime import datetime
+import numpy as np
 import pandas as pd
 from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis as QDA
 from dataeventhandler import strategy
 from dataeventhandler import signal_event
 from backtest import Backtest
 from Portfolio import portfolio
-from execution import SimulatedExecutionHandler
+from executionhandler import SimulatedExecutionHandler
 from dataeventhandler import securities_master_handler
-from forcasting import obtain_lagged_series
-import mysql.connector as msc
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.ensemble import RandomForestRegressor as rf
 
@@ -23,23 +22,46 @@ class SPYdailyforecastrategy(strategy):
     prediction.
     """
 
-    def __init__(self, bars, events):
+    def __init__(self, bars, events, model_start_date=datetime(2001, 1, 10), model_end_date=datetime(2005, 12, 31),
+                 model_start_test_date=datetime(2005, 1, 1), model=None):
+        """
+        model_start_date, model_end_date - The history the model is fitted on.
+        model_start_test_date - The first date held out of the fit for testing.
+        model - An already fitted model, e.g. from fit_params, used instead of
+        fitting one on the database history.
+        """
         self.bars = bars
-        self.symbol = self.bars.symbols
+        self.symbol = self.bars.symbols[0]
         self.events = events
         self.datetime_now = datetime.now()
-        self.model_start_date = datetime(2001, 1, 10)
-        self.model_end_date = datetime(2005, 12, 31)
-        self.model_start_test_date = datetime(2005, 1, 1)
+        self.model_start_date = model_start_date
+        self.model_end_date = model_end_date
+        self.model_start_test_date = model_start_test_date
         self.long_market = False
         self.short_market = False
         self.bar_index = 0
-        self.model = self.create_symbol_forecast_model()
+        self.model = model if model is not None else self.create_symbol_forecast_model()
+        self.bars.register_lookback(2)
+
+    @staticmethod
+    def fit_params(in_sample):
+        """
+        Fits the forecast on the returns of the first symbol of an in-sample
+        bar_store, for use as the fit of walkforward.walk_forward, so every
+        fold is fitted from the one shared load without querying the database.
+        """
+        returns = pd.Series(in_sample.column('returns', in_sample.symbols[0]) * 100.0)
+        lagged = pd.DataFrame({'lag1': returns.shift(1), 'lag2': returns.shift(2),
+                               'direction': np.sign(returns)}).dropna()
+        model = LDA()
+        model.fit(lagged[["lag1", "lag2"]], lagged["direction"])
+        return {'model': model}
 
     def create_symbol_forecast_model(self):
         """
         # Create a lagged series of the S&P500 US stock market index
         """
+        from forcasting import obtain_lagged_series
         lagged_series = obtain_lagged_series(self.symbol, self.model_start_date, self.model_end_date, 5)
         # Use the prior two days of returns as predictor
         # values, with direction as the response
@@ -66,7 +88,7 @@ class SPYdailyforecastrategy(strategy):
         if event.type == 'MARKET':
             self.bar_index += 1
             if self.bar_index > 5:
-                lags = self.bars.get_latest_bars(self.bar_index, 'returns')
+                lags = self.bars.get_latest_bars(2, 'returns')[sym]
                 pred_df = pd.DataFrame({'lag1': [lags[-1] * 100.0], 'lag2': [lags[-2] * 100.0]})
                 pred = self.model.predict(pred_df)
                 if pred > 0 and not self.long_market:
@@ -82,19 +104,18 @@ class SPYdailyforecastrategy(strategy):
 
 
 if __name__ == "__main__":
-    symbol = 'AAPL'
+    symbol = ['AAPL']
     db_host = 'localhost'
     db_user = 'sec_user'
     db_pass = 'Damilare20$'
     db_name = 'securities_master'
-    plug_in = 'caching_sha2_password'
     initial_capital = 100000.0
     heartbeat = 0
     # events = queue.Queue()
     start_date = datetime(2001, 1, 1, 0, 0, 0)
     # SMH = securities_master_handler(symbol, db_host, db_user, db_pass, db_name)
     # MAC = MovingAverageCrossStrategy(SMH, events)
-    backtest = Backtest(symbol, db_host, db_user, db_pass, db_name, plug_in, initial_capital,
+    backtest = Backtest(symbol, db_host, db_user, db_pass, db_name, initial_capital,
                         heartbeat, start_date, securities_master_handler, SimulatedExecutionHandler,
                         portfolio, SPYdailyforecastrategy)
     backtest.simulate_trading('close_price')
@@ -5,25 +5,134 @@ import queue
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-import mysql.connector as msc
+from instrumentation import backtest_profiler
+from dataeventhandler import event_bus
+from vectorized import vectorized_backtest, check_parity
+import checkpoint
+from journal import event_journal
 
 db_host = 'localhost'
 db_user = 'sec_user'
 db_pass = 'Damilare20%'
 db_name = 'securities_master'
-con = msc.connect(host=db_host, user=db_user, password=db_pass, db=db_name)
 
 
 
+class strategy_session(object):
+    """
+    A strategy paired with its own portfolio, execution handler and event
+    queue. A Backtest fans the MARKET events of its data handler out to
+    every session, and each session keeps its own signal, order and fill
+    accounting, so many strategies share a single pass over the data.
+    """
+    def __init__(self, data_handler, events, execution_handler, portfolio, strategy, start_date, symbols,
+                 initial_capital):
+        """
+        Parameters:
+        data_handler - The data handler shared by every session.
+        events - The event queue of this session.
+        execution_handler, portfolio, strategy - The classes, or factories,
+        of the session's components.
+        """
+        self.events = events
+        self.lock_free = isinstance(events, event_bus)
+        self.execution_handler = execution_handler(self.events)
+        self.portfolio = portfolio(data_handler, self.events, start_date, symbols, initial_capital)
+        self.strategy = strategy(data_handler, self.events)
+        self.signals = 0
+        self.orders = 0
+        self.fills = 0
+
+    def create_dispatch(self, profiler=None, journal=None, session_id=0):
+        """
+        Returns the table of event type to handler used to process
+        the session's events, timed by profiler if one is given and
+        recorded under session_id in journal if one is given.
+        """
+        calculate_signals = self.strategy.calculate_signals
+        update_time = self.portfolio.update_time
+        update_signal = self.portfolio.update_signal
+        execute_order = self.execution_handler.execute_order
+        update_fill = self.portfolio.update_fill
+        if profiler is not None:
+            calculate_signals = profiler.wrap('calculate_signals', calculate_signals)
+            update_time = profiler.wrap('update_time', update_time)
+            update_signal = profiler.wrap('update_signal', update_signal)
+            execute_order = profiler.wrap('execute_order', execute_order)
+            update_fill = profiler.wrap('update_fill', update_fill)
+        if journal is not None:
+            update_signal = journal.wrap(session_id, update_signal)
+            execute_order = journal.wrap(session_id, execute_order)
+            update_fill = journal.wrap(session_id, update_fill)
+
+        def on_market(event):
+            calculate_signals(event)
+            update_time(event)
+
+        def on_signal(event):
+            self.signals += 1
+            update_signal(event)
+
+        def on_order(event):
+            self.orders += 1
+            execute_order(event)
+
+        def on_fill(event):
+            self.fills += 1
+            update_fill(event)
+
+        return {'MARKET': on_market, 'SIGNAL': on_signal, 'ORDER': on_order, 'FILL': on_fill}
+
+    def drain(self, dispatch, track_depth=False):
+        """
+        Handles every event waiting on the session's queue and returns
+        the largest queue depth seen when track_depth is set.
+        """
+        events = self.events
+        depth = 0
+        if self.lock_free:
+            while events:
+                if track_depth:
+                    depth = max(depth, len(events))
+                event = events.popleft()
+                if event is not None:
+                    dispatch[event.type](event)
+        else:
+            while True:
+                if track_depth:
+                    depth = max(depth, events.qsize())
+                try:
+                    event = events.get(False)
+                except queue.Empty:
+                    break
+                if event is not None:
+                    dispatch[event.type](event)
+        return depth
+
+
 class Backtest(object):
     """
     Encapsulates the settings and components for carrying out
     an event-driven backtest.
     """
     def __init__(self, symbol, host, user, password, name, initial_capital, heartbeat, start_date, data_handler
-                 , execution_handler, portfolio, strategy):
+                 , execution_handler, portfolio, strategy, end_date=None, profile=False, live=False,
+                 checkpoint_every=None, checkpoint_path=None, journal_path=None, stop_condition=None):
         """
         Initialize the backtest.
+        strategy - A strategy class, or a list of them to run every strategy,
+        each with its own portfolio and execution handler, in one pass over the data.
+        live - Uses a thread safe queue.Queue for events arriving from other
+        threads instead of the lock free event_bus of single threaded backtests.
+        profile - Records per component timings, queue depth and throughput,
+        available from performance_report once the backtest has run.
+        checkpoint_every - Saves a checkpoint to checkpoint_path every
+        checkpoint_every bars, from which load_checkpoint resumes the run.
+        journal_path - Records every MARKET, SIGNAL, ORDER and FILL event to
+        a binary event_journal, which replay.replay_journal plays back.
+        stop_condition - A callable given the Backtest after every bar, ending
+        the run early when it returns True, e.g. performance.drawdown_limit
+        reading the online statistics of the portfolios.
         """
         self.symbols = symbol
         self.host = host
@@ -32,82 +141,190 @@ class Backtest(object):
         self.db_name = name
         self.initial_capital = initial_capital
         self.heartbeat = heartbeat
-        self.events = queue.Queue()
+        self.live = live
+        self.events = self.create_event_queue()
         self.start_date = start_date
-        self.data_handler = data_handler(self.events, self.symbols, self.host, self.user, self.password, self.db_name)
-        self.execution_handler = execution_handler(self.events)
-        self.portfolio = portfolio(self.data_handler, self.events, self.start_date, self.symbols, self.initial_capital)
-        self.strategy = strategy(self.data_handler, self.events)
-        self.signals = 0
-        self.orders = 0
-        self.fills = 0
-        self.num_strats = 1
+        self.end_date = end_date
+        self.data_handler = data_handler(self.events, self.symbols, self.host, self.user, self.password, self.db_name,
+                                         start_date=self.start_date, end_date=self.end_date)
+        strategies = strategy if isinstance(strategy, (list, tuple)) else [strategy]
+        self.sessions = [strategy_session(self.data_handler, self.create_event_queue(), execution_handler, portfolio,
+                                          strat, self.start_date, self.symbols, self.initial_capital)
+                         for strat in strategies]
+        self.execution_handler = self.sessions[0].execution_handler
+        self.portfolio = self.sessions[0].portfolio
+        self.strategy = self.sessions[0].strategy
+        self.num_strats = len(self.sessions)
+        self.profiler = backtest_profiler() if profile else None
+        self.vectorized = None
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_path = checkpoint_path
+        self.journal_path = journal_path
+        # The journal being written during a run, and the size to cut it
+        # back to when resuming from a checkpoint
+        self.journal = None
+        self.journal_offset = None
+        self.stop_condition = stop_condition
+        self.stopped_early = False
+        if checkpoint_every and checkpoint_path is None:
+            raise ValueError("checkpoint_every needs a checkpoint_path")
+
+    @property
+    def signals(self):
+        return self.sessions[0].signals
+
+    @property
+    def orders(self):
+        return self.sessions[0].orders
+
+    @property
+    def fills(self):
+        return self.sessions[0].fills
+
+    def create_event_queue(self):
+        return queue.Queue() if self.live else event_bus()
+
+    def save_checkpoint(self, path=None):
+        """
+        Saves the state of the backtest between two bars, see checkpoint.save_checkpoint.
+        """
+        checkpoint.save_checkpoint(self, path or self.checkpoint_path)
+
+    def load_checkpoint(self, path=None):
+        """
+        Restores a checkpoint, so that run_backtest carries on from
+        the bar after it. Returns the number of bars already handled.
+        """
+        return checkpoint.load_checkpoint(self, path or self.checkpoint_path)
 
     def run_backtest(self, price_type):
         """
-        executes the backtest
+        executes the backtest, sending every MARKET event of the
+        data handler to each strategy session in turn, from the
+        bar after the last one handled when resuming from a checkpoint
         """
-        i = -1
-        gen = self.data_handler.get_new_bar(price_type)
+        update_bars = self.data_handler.update_bars
+        profiler = self.profiler
+        if profiler is not None:
+            update_bars = profiler.wrap('update_bars', update_bars)
+            profiler.start()
+        track_depth = profiler is not None
+        journal = None
+        if self.journal_path is not None:
+            journal = event_journal(self.journal_path, self.symbols, price_type, self.initial_capital,
+                                    self.start_date, [type(session.strategy).__name__ for session in self.sessions],
+                                    append=self.data_handler.bar_index > 0, offset=self.journal_offset)
+            self.journal = journal
+        sessions = [(session, session.create_dispatch(profiler, journal, k)) for k, session in enumerate(self.sessions)]
+        events = self.events
+        checkpoint_every = self.checkpoint_every
+        stop_condition = self.stop_condition
+        i = self.data_handler.bar_index - 1
+        saved = i + 1
+        gen = self.data_handler.get_new_bar(price_type, self.data_handler.bar_index)
         while True:
             i += 1
-            print(i)
         # Update the market bars
             if self.data_handler.continue_backtest:
-                self.data_handler.update_bars(price_type, gen, i)
+                update_bars(price_type, gen, i)
             else:
                 break
         # Handle the events
-            while True:
-                try:
-                    event = self.events.get(False)
-                except queue.Empty:
-                    break
-                else:
-                    if event is not None:
-                        if event.type == 'MARKET':
-                            self.strategy.calculate_signals(event)
-                            self.portfolio.update_time(event)
-                        elif event.type == 'SIGNAL':
-                            self.signals += 1
-                            self.portfolio.update_signal(event)
-                        elif event.type == 'ORDER':
-                            self.orders += 1
-                            self.execution_handler.execute_order(event)
-                        elif event.type == 'FILL':
-                            self.fills += 1
-                            self.portfolio.update_fill(event)
-            time.sleep(self.heartbeat)
+            depth = 0
+            while not events.empty():
+                event = events.get(False)
+                if event is None:
+                    continue
+                if journal is not None and event.type == 'MARKET':
+                    journal.write_market(self.data_handler)
+                for session, dispatch in sessions:
+                    dispatch[event.type](event)
+                    depth = max(depth, session.drain(dispatch, track_depth))
+            if self.live:
+                # Fills may arrive from the broker after the bar was handled
+                for session, dispatch in sessions:
+                    session.drain(dispatch)
+            if profiler is not None:
+                profiler.record_bar(depth)
+            if checkpoint_every and self.data_handler.bar_index % checkpoint_every == 0 \
+                    and self.data_handler.bar_index != saved:
+                saved = self.data_handler.bar_index
+                self.save_checkpoint()
+            if stop_condition is not None and stop_condition(self):
+                self.stopped_early = True
+                break
+            if self.heartbeat:
+                time.sleep(self.heartbeat)
+        if profiler is not None:
+            profiler.stop()
+        if journal is not None:
+            journal.close()
+            self.journal = None
+
+    def run_vectorized(self, price_type):
+        """
+        Runs the strategy with the vectorized engine over the whole
+        loaded history, leaving the portfolio untouched, and returns
+        the equity curve.
+        """
+        store = self.data_handler.pull_data(price_type)
+        self.vectorized = vectorized_backtest(store, self.strategy, self.start_date, self.initial_capital,
+                                              price_type, self.portfolio.order_quantity)
+        return self.vectorized.run()
+
+    def check_parity(self, price_type):
+        """
+        Runs both the vectorized engine and the event-driven loop on the
+        same data and returns whether their equity curves match.
+        """
+        vector_curve = self.run_vectorized(price_type)
+        self.run_backtest(price_type)
+        return check_parity(self.portfolio.create_equity_curve_dataframe(), vector_curve)
+
+    def performance_report(self):
+        """
+        Returns the timing report of the last run, or None
+        if the backtest was created without profiling.
+        """
+        if self.profiler is None:
+            return None
+        return self.profiler.report()
 
     def output_performance(self):
         """
-        Outputs the strategy performance from the backtest.
+        Outputs the performance of every strategy from the backtest.
         """
-        self.portfolio.create_equity_curve_dataframe()
-        print("Creating summary stats...")
-        stats = self.portfolio.output_summary_stats()
-        print("Creating equity curve...")
-        print(self.portfolio.create_equity_curve_dataframe())
-        pprint.pprint(stats)
-        print("Signals: %s" % self.signals)
-        print("Orders: %s" % self.orders)
-        print("Fills: %s" % self.fills)
+        for k, session in enumerate(self.sessions):
+            if self.num_strats > 1:
+                print("Strategy %s: %s" % (k, type(session.strategy).__name__))
+            print("Creating summary stats...")
+            stats = session.portfolio.output_summary_stats()
+            print("Creating equity curve...")
+            print(session.portfolio.create_equity_curve_dataframe())
+            pprint.pprint(stats)
+            print("Signals: %s" % session.signals)
+            print("Orders: %s" % session.orders)
+            print("Fills: %s" % session.fills)
 
     def plot_values(self):
-        data = self.portfolio.create_equity_curve_dataframe()
         # Plot three charts: Equity curve,
         # period returns, drawdowns
         fig = plt.figure(figsize=(8,10))
         # Set the outer colour to white
         fig.patch.set_facecolor('white')
-        # Plot the equity curve
         ax1 = fig.add_subplot(311, ylabel='Portfolio value, % ')
-        data['equity_curve'].plot(ax=ax1, color="blue", lw=2.)
-        plt.grid(True)
-        # Plot the returns
         ax2 = fig.add_subplot(312, ylabel='Period returns, % ')
-        data['returns'].plot(ax=ax2, color="black", lw=2.)
-        plt.grid(True)
+        for k, session in enumerate(self.sessions):
+            data = session.portfolio.create_equity_curve_dataframe()
+            label = "%s %s" % (k, type(session.strategy).__name__)
+            # Plot the equity curve
+            data['equity_curve'].plot(ax=ax1, color="blue" if k == 0 else None, lw=2., label=label)
+            # Plot the returns
+            data['returns'].plot(ax=ax2, color="black" if k == 0 else None, lw=2., label=label)
+        ax1.grid(True)
+        ax2.grid(True)
+        if self.num_strats > 1:
+            ax1.legend()
         # Plot the figure
         plt.tight_layout()
         plt.show()
@@ -117,24 +334,7 @@ class Backtest(object):
         Simulates the backtest and outputs portfolio performance.
         """
         self.run_backtest(price_type)
-        print(self.strategy.bought)
+        for session in self.sessions:
+            print(getattr(session.strategy, 'bought', None))
         self.output_performance()
         self.plot_values()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,250 @@
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+
+class bar_store(object):
+    """
+    Columnar storage for the bars of a universe of symbols.
+    Every field (open_price, close_price, returns, ...) is held in a
+    single (bars x symbols) matrix in Fortran order, so the history of
+    each symbol is one contiguous array, and all symbols share one
+    date index.
+    """
+    def __init__(self, symbols, dates, fields):
+        """
+        Initialises the bar_store.
+        Parameters:
+        symbols - The list of ticker symbols, one per column.
+        dates - A numpy datetime64 array shared by every symbol.
+        fields - A dictionary mapping field names to (bars x symbols) arrays.
+        """
+        self.symbols = list(symbols)
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.dates = dates
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.dates)
+
+    def column(self, field, symbol):
+        """
+        Returns the full history of a field for one symbol as a view.
+        """
+        return self.fields[field][:, self.symbol_index[symbol]]
+
+    def row(self, field, i):
+        """
+        Returns the values of a field for every symbol at bar i.
+        """
+        return self.fields[field][i]
+
+    def slice(self, start, stop):
+        """
+        Returns a bar_store of bars start to stop whose arrays
+        are views of this store's arrays.
+        """
+        fields = {field: values[start:stop] for field, values in self.fields.items()}
+        return bar_store(self.symbols, self.dates[start:stop], fields)
+
+    @classmethod
+    def from_frames(cls, frames, fields, fill_policy='ffill'):
+        """
+        Builds a store from the list of per symbol dataframes returned by
+        securities_master_handler.get_prices, the first column of each
+        frame being named after its ticker. Every symbol is placed on one
+        master calendar, the union of all price dates, which starts on the
+        first date every symbol has a previous close. Missing bars are
+        handled according to fill_policy:
+        'ffill' - carry the last prices forward with zero volume
+        'nan' - leave the missing bar as NaN
+        'skip' - drop every date on which any symbol is missing
+        Returns are computed from the aligned close prices.
+        """
+        if fill_policy not in ('ffill', 'nan', 'skip'):
+            raise ValueError("Unknown fill policy %s" % fill_policy)
+        symbols = [frame.columns[0] for frame in frames]
+        lengths = [len(frame) for frame in frames]
+        all_dates = pd.to_datetime(np.concatenate([frame['price_date'].values for frame in frames])).values
+        calendar, rows = np.unique(all_dates, return_inverse=True)
+        cols = np.repeat(np.arange(len(frames)), lengths)
+        present = np.zeros((len(calendar), len(frames)), dtype=bool)
+        present[rows, cols] = True
+        price_fields = [field for field in fields if field != 'returns']
+        data = {}
+        for field in price_fields:
+            matrix = np.full((len(calendar), len(frames)), np.nan)
+            matrix[rows, cols] = np.concatenate([frame[field].values for frame in frames]).astype(np.float64)
+            data[field] = matrix
+        start = present.argmax(axis=0).max()
+        if fill_policy == 'skip':
+            keep = np.flatnonzero(present.all(axis=1))
+        else:
+            keep = np.arange(start, len(calendar))
+        if fill_policy == 'ffill':
+            last = np.where(present, np.arange(len(calendar))[:, None], 0)
+            np.maximum.accumulate(last, axis=0, out=last)
+            for field in price_fields:
+                filled = np.take_along_axis(data[field], last, axis=0)
+                if field == 'volume':
+                    filled[~present] = 0.0
+                data[field] = filled
+        # The first kept date only provides the previous close for returns
+        close = data['close_price'][keep]
+        store_fields = {}
+        for field in fields:
+            if field == 'returns':
+                values = close[1:] / close[:-1] - 1.0
+            else:
+                values = data[field][keep[1:]]
+            store_fields[field] = np.asfortranarray(values)
+        return cls(symbols, calendar[keep[1:]], store_fields)
+
+
+class lookback_buffer(object):
+    """
+    Fixed capacity circular buffer holding the most recent bars of every
+    field for a universe of symbols. Each row is written twice, capacity
+    rows apart, so the last N rows are always one contiguous slice and
+    every window is returned as a view without copying.
+    """
+    def __init__(self, symbols, fields, capacity):
+        """
+        Initialises the lookback_buffer.
+        Parameters:
+        symbols - The list of ticker symbols, one per column.
+        fields - The names of the fields held for each bar.
+        capacity - The number of bars kept.
+        """
+        self.symbols = list(symbols)
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.capacity = max(int(capacity), 1)
+        self.size = 0
+        self.pos = 0
+        self.dates = np.empty(2 * self.capacity, dtype='datetime64[ns]')
+        self.fields = {}
+        for field in fields:
+            self.fields[field] = np.full((2 * self.capacity, len(self.symbols)), np.nan)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, date, row):
+        """
+        Writes a new bar, overwriting the oldest one once full.
+        row maps each field to its values for every symbol.
+        """
+        p = self.pos
+        q = p + self.capacity
+        self.dates[p] = date
+        self.dates[q] = date
+        for field, values in self.fields.items():
+            values[p] = row[field]
+            values[q] = row[field]
+        self.pos = (p + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def bounds(self, n):
+        """
+        Returns the start and stop rows of the last n bars.
+        """
+        stop = (self.pos - 1) % self.capacity + self.capacity + 1
+        return stop - min(n, self.size), stop
+
+    def window(self, field, n):
+        """
+        Returns a view of the last n bars of a field for every symbol,
+        or n-k bars if less are available.
+        """
+        start, stop = self.bounds(n)
+        return self.fields[field][start:stop]
+
+    def dates_window(self, n):
+        """
+        Returns a view of the dates of the last n bars.
+        """
+        start, stop = self.bounds(n)
+        return self.dates[start:stop]
+
+    def latest(self, field):
+        """
+        Returns a view of the last bar of a field for every symbol.
+        """
+        return self.fields[field][self.bounds(1)[1] - 1]
+
+    def resize(self, capacity):
+        """
+        Returns a new buffer of the given capacity holding
+        as many of the latest bars as fit.
+        """
+        buffer = lookback_buffer(self.symbols, list(self.fields.keys()), capacity)
+        start, stop = self.bounds(buffer.capacity)
+        for i in range(start, stop):
+            buffer.append(self.dates[i], {field: values[i] for field, values in self.fields.items()})
+        return buffer
+
+
+class shared_bar_store(object):
+    """
+    Copies the arrays of a bar_store into multiprocessing shared memory
+    once, so that worker processes can attach to the same prices with
+    attach_store instead of loading or unpickling their own copy.
+    """
+    def __init__(self, store):
+        """
+        Parameters:
+        store - The bar_store to share.
+        """
+        self.blocks = []
+        self.descriptor = {
+            'symbols': list(store.symbols),
+            'dates': self.share(store.dates),
+            'fields': {field: self.share(values) for field, values in store.fields.items()}
+        }
+
+    def share(self, array):
+        """
+        Copies an array into a new shared memory block and
+        returns the description needed to attach to it.
+        """
+        order = 'F' if array.flags['F_CONTIGUOUS'] and not array.flags['C_CONTIGUOUS'] else 'C'
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, order=order)
+        view[...] = array
+        self.blocks.append(block)
+        return block.name, array.shape, array.dtype.str, order
+
+    def close(self):
+        """
+        Releases and removes the shared memory blocks.
+        """
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach_shared_array(name, shape, dtype, order):
+    """
+    Returns the shared memory block called name and an
+    array viewing it without copying.
+    """
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf, order=order)
+
+
+def attach_store(descriptor):
+    """
+    Returns a bar_store whose arrays view the shared memory described by
+    shared_bar_store.descriptor, together with the blocks, which must be
+    kept open for as long as the store is used.
+    """
+    blocks = []
+    block, dates = attach_shared_array(*descriptor['dates'])
+    blocks.append(block)
+    fields = {}
+    for field, description in descriptor['fields'].items():
+        block, fields[field] = attach_shared_array(*description)
+        blocks.append(block)
+    return bar_store(descriptor['symbols'], dates, fields), blocks
@@ -0,0 +1,75 @@
+import datetime
+import time
+import numpy as np
+from barstore import bar_store
+from dataeventhandler import securities_master_handler, event_bus, fill_event
+from Portfolio import portfolio
+
+FIELDS = ['open_price', 'high_price', 'low_price', 'close_price', 'volume', 'returns']
+
+
+def synthetic_store(n_symbols, n_bars, seed=0):
+    """
+    Returns a bar_store of random walk prices for n_symbols symbols over
+    n_bars minute bars, with every field filled.
+    """
+    rng = np.random.default_rng(seed)
+    symbols = ['S%05d' % j for j in range(n_symbols)]
+    dates = np.datetime64('2020-01-02T09:30', 'ns') + np.arange(n_bars) * np.timedelta64(60, 's')
+    returns = rng.normal(0.0, 0.001, (n_bars, n_symbols))
+    close = 100.0 * np.exp(np.cumsum(returns, axis=0))
+    fields = {field: np.asfortranarray(close) for field in FIELDS}
+    fields['volume'] = np.asfortranarray(rng.integers(100, 10000, (n_bars, n_symbols)).astype(np.float64))
+    fields['returns'] = np.asfortranarray(returns)
+    return bar_store(symbols, dates, fields)
+
+
+def time_mark_to_market(n_symbols, n_bars=500, fills_per_bar=10, seed=0):
+    """
+    Times the per bar cost of pushing a bar to the data handler and
+    marking a portfolio to market, with fills_per_bar fills on random
+    symbols each bar.
+    Returns the mean seconds per bar of the push, the fills and update_time.
+    """
+    store = synthetic_store(n_symbols, n_bars, seed)
+    events = event_bus()
+    bars = securities_master_handler(events, store.symbols, None, None, None, None, store=store)
+    book = portfolio(bars, events, datetime.datetime(2020, 1, 1), store.symbols, 1000000.0)
+    gen = bars.get_new_bar('close_price')
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, n_symbols, (n_bars, fills_per_bar))
+    push = fill = mark = 0.0
+    clock = time.perf_counter
+    for i in range(n_bars):
+        start = clock()
+        bars.update_bars('close_price', gen, None)
+        events.clear()
+        pushed = clock()
+        for j in picks[i]:
+            book.update_fill(fill_event(None, store.symbols[j], 'ARCA', 10, 'BUY' if i % 2 == 0 else 'SELL',
+                                        None, 1.0))
+        filled = clock()
+        book.update_time(None)
+        marked = clock()
+        push += pushed - start
+        fill += filled - pushed
+        mark += marked - filled
+    return push / n_bars, fill / n_bars, mark / n_bars
+
+
+def run_benchmark(sizes=(10, 100, 1000, 5000), n_bars=500, fills_per_bar=10):
+    """
+    Prints the per bar cost of the data handler and portfolio for each
+    universe size, the cost per symbol staying flat as the universe grows.
+    """
+    print("%8s %12s %12s %12s %12s %14s" % ('symbols', 'push (us)', 'fills (us)', 'mark (us)', 'total (us)',
+                                           'per symbol (ns)'))
+    for n in sizes:
+        push, fill, mark = time_mark_to_market(n, n_bars, fills_per_bar)
+        total = push + fill + mark
+        print("%8d %12.1f %12.1f %12.1f %12.1f %14.1f" % (n, push * 1e6, fill * 1e6, mark * 1e6, total * 1e6,
+                                                           total * 1e9 / n))
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,107 @@
+import os
+import pickle
+import queue
+from dataeventhandler import event_bus
+
+# Bumped whenever the layout of a checkpoint changes
+CHECKPOINT_VERSION = 2
+
+
+def component_state(component, shared):
+    """
+    Returns the attributes of a strategy, portfolio or execution handler,
+    leaving out its references to objects shared with the rest of the
+    backtest, such as the data handler and the event queues, which are
+    saved once on their own.
+    """
+    return {name: value for name, value in vars(component).items()
+            if not any(value is obj for obj in shared)}
+
+
+def queue_contents(events):
+    """
+    Returns the events waiting on an event_bus or queue.Queue in order.
+    """
+    if isinstance(events, event_bus):
+        return list(events)
+    with events.mutex:
+        return list(events.queue)
+
+
+def restore_queue(events, contents):
+    """
+    Replaces the events waiting on a queue with contents.
+    """
+    while True:
+        try:
+            events.get(False)
+        except queue.Empty:
+            break
+    for event in contents:
+        events.put(event)
+
+
+def save_checkpoint(backtest, path):
+    """
+    Writes the state of a backtest between two bars to path as a binary
+    pickle: the data handler cursor, lookback buffer and indicators, the
+    pending events, the size of the event journal being written if any and,
+    for every strategy session, the strategy, portfolio and execution
+    handler state with their counters. The file is replaced
+    atomically, so a crash while saving leaves the previous checkpoint intact.
+    """
+    handler = backtest.data_handler
+    sessions = []
+    for session in backtest.sessions:
+        shared = (handler, backtest.events, session.events)
+        sessions.append({
+            'strategy': component_state(session.strategy, shared),
+            'portfolio': component_state(session.portfolio, shared),
+            'execution_handler': component_state(session.execution_handler, shared),
+            'events': queue_contents(session.events),
+            'signals': session.signals,
+            'orders': session.orders,
+            'fills': session.fills
+        })
+    state = {
+        'version': CHECKPOINT_VERSION,
+        'symbols': list(backtest.symbols),
+        'handler': handler.get_state(),
+        'events': queue_contents(backtest.events),
+        'journal_offset': backtest.journal.offset() if backtest.journal is not None else None,
+        'sessions': sessions
+    }
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(backtest, path):
+    """
+    Restores a checkpoint written by save_checkpoint into a backtest built
+    with the same symbols and number of strategies. Running the backtest
+    afterwards carries on from the bar after the checkpoint, so a killed
+    run can be resumed, or several backtests can branch from one checkpoint.
+    Returns the number of bars already handled.
+    """
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state['version'] != CHECKPOINT_VERSION:
+        raise ValueError("Unsupported checkpoint version %s" % state['version'])
+    if state['symbols'] != list(backtest.symbols):
+        raise ValueError("The checkpoint was saved for the symbols %s" % state['symbols'])
+    if len(state['sessions']) != len(backtest.sessions):
+        raise ValueError("The checkpoint was saved with %s strategies" % len(state['sessions']))
+    backtest.data_handler.set_state(state['handler'])
+    restore_queue(backtest.events, state['events'])
+    backtest.journal_offset = state['journal_offset']
+    for session, saved in zip(backtest.sessions, state['sessions']):
+        vars(session.strategy).update(saved['strategy'])
+        vars(session.portfolio).update(saved['portfolio'])
+        vars(session.execution_handler).update(saved['execution_handler'])
+        restore_queue(session.events, saved['events'])
+        session.signals = saved['signals']
+        session.orders = saved['orders']
+        session.fills = saved['fills']
+    return backtest.data_handler.bar_index
@@ -1,7 +1,16 @@
 from abc import ABCMeta, abstractmethod
-import mysql.connector as msc
+from collections import deque
+import queue
+import heapq
+import itertools
+from operator import itemgetter
 import pandas as pd
 import warnings
+import numpy as np
+from barstore import bar_store, lookback_buffer
+from pricecache import price_cache
+import derived
+import dbpool
 
 warnings.filterwarnings('ignore')
 
@@ -10,9 +19,11 @@ class event(object):
     """
     Event is base class providing an interface for all subsequent
     (inherited) events, that will trigger further events in the
-    trading infrastructure.
+    trading infrastructure. Events are slotted and their type is a
+    class attribute, so instances carry no per-instance __dict__.
     """
-    pass
+    __slots__ = ()
+    type = None
 
 
 class market_event(event):
@@ -20,14 +31,20 @@ class market_event(event):
     Handles the event of receiving a new market update with
     corresponding bars.
     """
-    def __init__(self):
-        self.type = 'MARKET'
+    __slots__ = ()
+    type = 'MARKET'
+
+
+# Market events carry no data, so one instance is shared by every bar
+MARKET_EVENT = market_event()
 
 
 class signal_event(event):
     """
     Sends a signal from strategy object to portfolio object
     """
+    __slots__ = ('strategy_id', 'symbol', 'datetime', 'signal_type', 'strength')
+    type = 'SIGNAL'
 
     def __init__(self, strategy_id, symbol, datetime, signal_type, strength):
         """
@@ -40,7 +57,6 @@ class signal_event(event):
         print(portfolio.construct_holdings())ORT'
         strength: measures the strength of the signal (useful for pairs trading)
         """
-        self.type = 'SIGNAL'
         self.strategy_id = strategy_id
         self.symbol = symbol
         self.datetime = datetime
@@ -54,6 +70,9 @@ class order_event(event):
     The order contains a symbol (e.g. AAPL), a type (market or limit)
     , quantity and a direction
     """
+    __slots__ = ('symbol', 'order_type', 'quantity', 'direction')
+    type = 'ORDER'
+
     def __init__(self, symbol, order_type, quantity, direction):
         """
         symbol - The instrument to trade.
@@ -61,7 +80,6 @@ class order_event(event):
         quantity - Non-negative integer for quantity.
         direction - 'BUY' or 'SELL' for long or short.
         """
-        self.type = 'ORDER'
         self.symbol = symbol
         self.order_type = order_type
         self.quantity = quantity
@@ -76,6 +94,15 @@ class order_event(event):
             (self.symbol, self.order_type, self.quantity, self.direction))
 
 
+def ib_commission(quantity):
+    """
+    Returns the Interactive Brokers API fee, in CAD, of trading a
+    quantity, or an array of quantities, of shares.
+    """
+    quantity = np.abs(quantity)
+    return np.where(quantity <= 300000, 0.01 * quantity, 0.0)
+
+
 class fill_event(event):
     """
     Encapsulates the notion of a Filled Order, as returned
@@ -83,6 +110,8 @@ class fill_event(event):
     actually filled and at what price. In addition, stores
     the commission of the trade from the brokerage.
     """
+    __slots__ = ('time_index', 'symbol', 'exchange', 'quantity', 'direction', 'fill_cost', 'commission')
+    type = 'FILL'
 
     def __init__(self, time_index, symbol, exchange, quantity, direction, fill_cost, commission = None):
         """Parameters:
@@ -94,7 +123,6 @@ class fill_event(event):
         fill_cost - The holdings value in dollars.
         commission - An optional commission sent from Interactive Brokers
         """
-        self.type = 'FILL'
         self.time_index = time_index
         self.symbol = symbol
         self.exchange = exchange
@@ -113,10 +141,32 @@ class fill_event(event):
         Brokers fee structure for API, in CAD
         based on : https://www.interactivebrokers.com/en/index.php?f=commission&p=stocks2
         """
-        cost = 0
-        if self.quantity <= 300000:
-            cost = 0.01 * self.quantity
-        return cost
+        return float(ib_commission(self.quantity))
+
+
+class event_bus(deque):
+    """
+    Lock free event queue for single threaded backtests. It keeps the
+    put/get interface of queue.Queue used by the data handlers, strategies,
+    portfolio and execution handlers, but takes no lock and lets the
+    backtest loop drain it with popleft until empty instead of catching
+    queue.Empty. Live trading, where events arrive from other threads,
+    keeps using queue.Queue.
+    """
+    __slots__ = ()
+    put = deque.append
+
+    def get(self, block=False):
+        try:
+            return self.popleft()
+        except IndexError:
+            raise queue.Empty
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return not self
 
 
 class data_handler(object):
@@ -132,9 +182,9 @@ class data_handler(object):
     __metaclass__ = ABCMeta
 
     @abstractmethod
-    def get_latest_bars(self, n):
+    def get_latest_bars(self, n, field=None):
         """
-        Returns the last N bars updated.
+        Returns the last N bars updated for a field or list of fields.
         """
         raise NotImplementedError("Should implement get_latest_bars()")
 
@@ -155,7 +205,189 @@ class data_handler(object):
         raise NotImplementedError("Should implement update_bars()")
 
 
-class securities_master_handler(data_handler):
+class buffered_data_handler(data_handler):
+    """
+    buffered_data_handler keeps the latest bars of every field in a fixed
+    capacity lookback_buffer and implements the "latest" bar interface on
+    top of it. The capacity is the largest lookback registered by the
+    strategies and portfolio using the handler, so memory stays constant
+    however long the run is. Subclasses feed bars in through push_bar.
+    """
+    def __init__(self, events, symbols, fields):
+        """
+        Parameters:
+            events - The event queue
+            symbols - The list of ticker symbols
+            fields - The names of the fields held for each bar
+        """
+        self.events = events
+        self.symbols = symbols
+        self.fields = fields
+        self.price_type = 'close_price'
+        self.lookback = 1
+        self.buffer = None
+        self.indicators = {}
+        self.bar_index = 0
+        self.continue_backtest = True
+
+    def register_lookback(self, n):
+        """
+        Declares that a consumer of the handler reads up to n bars back.
+        The buffer is sized to the largest lookback registered.
+        """
+        if n > self.lookback:
+            self.lookback = n
+            if self.buffer is not None:
+                self.buffer = self.buffer.resize(self.lookback)
+
+    def check_lookback(self, n):
+        """
+        Raises ValueError if n bars are requested while fewer are kept.
+        """
+        if n > self.lookback:
+            raise ValueError("%s bars requested but the lookback is %s, call register_lookback(%s) first"
+                             % (n, self.lookback, n))
+
+    def push_bar(self, date, row):
+        """
+        Appends a bar to the lookback buffer.
+        row maps each field to its values for every symbol.
+        """
+        if self.buffer is None:
+            self.buffer = lookback_buffer(self.symbols, self.fields, self.lookback)
+        self.buffer.append(date, row)
+        for indicator, field in self.indicators.values():
+            indicator.update(row[field] if field is not None else None)
+        self.bar_index += 1
+
+    def register_indicator(self, indicator, field=None):
+        """
+        Registers an incremental indicator updated with the values of field
+        for every symbol on each new bar, in registration order, and returns
+        the key to read it with. An indicator identical to one already
+        registered is shared rather than updated twice.
+        Parameters:
+            indicator - An indicators.indicator instance
+            field - The field fed to the indicator, or None for indicators
+            combining other indicators such as crossover
+        """
+        if field is not None and field not in self.fields:
+            raise KeyError("%s is not a field of this data handler" % field)
+        key = indicator.name if field is None else '%s_%s' % (indicator.name, field)
+        if key not in self.indicators:
+            if self.bar_index > 0:
+                raise ValueError("Indicators must be registered before the first bar")
+            self.indicators[key] = (indicator, field)
+        return key
+
+    def get_indicator(self, key):
+        """
+        Returns the registered indicator object of a key.
+        """
+        return self.indicators[key][0]
+
+    def get_indicator_value(self, key, symbol=None):
+        """
+        Returns the current value of an indicator for one symbol, or the
+        array of its values for every symbol when symbol is None.
+        """
+        value = self.indicators[key][0].value
+        if symbol is None or value is None:
+            return value
+        return value[self.buffer.symbol_index[symbol]]
+
+    def get_state(self):
+        """
+        Returns the cursor, lookback buffer and indicators of the handler,
+        everything a checkpoint needs to carry on from the latest bar.
+        """
+        return {
+            'price_type': self.price_type,
+            'lookback': self.lookback,
+            'buffer': self.buffer,
+            'indicators': self.indicators,
+            'bar_index': self.bar_index,
+            'continue_backtest': self.continue_backtest
+        }
+
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state.
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def get_latest_bar(self):
+        """
+        Returns the last bar as a dictionary of the date and
+        the values of each field for every symbol.
+        """
+        if self.buffer is None:
+            return None
+        bar = {'Date': self.buffer.dates_window(1)[-1]}
+        for field in self.fields:
+            bar[field] = self.buffer.latest(field)
+        return bar
+
+    def get_latest_bar_value(self, symbol, field=None):
+        """Returns the latest bar values for a symbol
+        in the latest symbol data structure
+        field - The field to read, price_type by default
+        """
+        try:
+            j = self.buffer.symbol_index[symbol]
+        except KeyError:
+            print("That symbol is not available in the historical data set.")
+            raise
+        else:
+            return self.buffer.latest(field or self.price_type)[j]
+
+    def get_latest_bar_values(self, field=None):
+        """
+        Returns the latest values of a field for every symbol, in symbol
+        order, as one view of the lookback buffer.
+        field - The field to read, price_type by default
+        """
+        if self.buffer is None:
+            return None
+        return self.buffer.latest(field or self.price_type)
+
+    def get_latest_bars(self, N, field=None):
+        """
+        Returns the last N bars for every symbol as views of the
+        lookback buffer, or N-k if less available.
+        field - A field name, price_type by default, giving a dictionary of
+        symbol to values, or a list of fields giving a dictionary of field
+        to such dictionaries.
+        Raises ValueError if N is larger than the registered lookback, as
+        the buffer would silently return fewer bars than exist.
+        """
+        self.check_lookback(N)
+        if field is None:
+            field = self.price_type
+        if not isinstance(field, str):
+            return {name: self.get_latest_bars(N, name) for name in field}
+        if field not in self.fields:
+            raise KeyError("%s is not a field of this data handler" % field)
+        if self.buffer is None:
+            return {symbol: np.empty(0) for symbol in self.symbols}
+        window = self.buffer.window(field, N)
+        bars_dict = {}
+        for symbol, j in self.buffer.symbol_index.items():
+            bars_dict[symbol] = window[:, j]
+        return bars_dict
+
+    def get_latest_bars_datetime(self, N):
+        """
+        Returns the dates of the last N bars.
+        """
+        self.check_lookback(N)
+        if self.buffer is None:
+            return np.empty(0, dtype='datetime64[ns]')
+        return self.buffer.dates_window(N)
+
+
+class securities_master_handler(buffered_data_handler):
 
     """
     securities_master_handler is designed to obtain data form securities database for
@@ -163,7 +395,8 @@ class securities_master_handler(data_handler):
     to obtain the "latest" bar in a manner identical to a live
     trading interface.
     """
-    def __init__(self, events, symbols, host, user, password, name):
+    def __init__(self, events, symbols, host, user, password, name, start_date=None, end_date=None, pool_size=2,
+                 cache_dir=None, chunk_size=None, fill_policy='ffill', store=None):
         """
         initialises the securities_master_handler by connecting to the database and
         pulling data concerning the symbols in the symbol list
@@ -174,148 +407,357 @@ class securities_master_handler(data_handler):
             user - The database user
             password - The database password
             name - The database name
-        """
-        self.symbols = symbols
+            start_date - The first price date to load, or None for the full history
+            end_date - The last price date to load, or None for the full history
+            pool_size - The number of pooled database connections
+            cache_dir - A directory for a local price_cache, or None to always read the database
+            chunk_size - Rows fetched per query when streaming bars, or None to load everything up front
+            fill_policy - How bars missing from the master calendar are filled: 'ffill', 'nan' or 'skip'
+            store - A bar_store already loaded, e.g. from shared memory, used instead of the database
+        """
+        buffered_data_handler.__init__(self, events, symbols,
+                                       ['open_price', 'high_price', 'low_price', 'close_price', 'volume', 'returns'])
         self.host = host
         self.user = user
         self.password = password
         self.db_name = name
-        self.events = events
-        self.symbol_data =  []
-        self.latest_symbol_data = []
-        self.continue_backtest = True
+        self.start_date = start_date
+        self.end_date = end_date
+        self.pool_size = pool_size
+        self.cache = price_cache(cache_dir) if cache_dir is not None else None
+        self.chunk_size = chunk_size
+        self.fill_policy = fill_policy
+        self.derived = {}
+        self.store = store
+        if store is not None:
+            self.fields = list(store.fields.keys())
+
+
+    def get_connection(self):
+        """
+        Returns a connection from the shared pool of the database,
+        which is only opened on first use. Closing the connection hands it back.
+        """
+        return dbpool.get_connection(self.host, self.user, self.password, self.db_name, self.pool_size)
 
     def get_prices_id(self):
         """
         Locates the corresponding symbol ID for each ticker in the list of tickers
-        returns a pandas dataframe for IDs
-        """
-        con = msc.connect(host=self.host, user=self.user, password=self.password, db=self.db_name)
+        returns a dictionary of ticker to symbol ID
+        """
+        placeholders = ', '.join(['%s'] * len(self.symbols))
+        select_str = """SELECT securities_master.symbol.ticker, securities_master.symbol.id
+                        from securities_master.symbol
+                        where securities_master.symbol.ticker IN (%s)
+                     """ % placeholders
+        con = self.get_connection()
+        try:
+            df = pd.read_sql_query(select_str, con, params=list(self.symbols))
+        finally:
+            con.close()
+        ids = dict(zip(df['ticker'], df['id']))
         symbols = {}
         for ticker in self.symbols:
-            select_str = """
-            SELECT securities_master.symbol.id
-            from securities_master.symbol
-            where securities_master.symbol.ticker = '%s'
-            """ % ticker
-            df = pd.read_sql_query(select_str, con)
-            symbols[ticker] = df.iloc[0, 0]
+            if ticker not in ids:
+                raise KeyError("%s is not in the securities master" % ticker)
+            symbols[ticker] = int(ids[ticker])
         return symbols
 
+    def query_prices(self, locations, since=None):
+        """
+        Runs a single query for the daily prices of every symbol ID in locations.
+        since maps tickers to the last price_date already held locally, in which
+        case only newer rows are fetched for that symbol and the backtest date
+        range is ignored. Returns one dataframe ordered by symbol_id and price_date.
+        """
+        select_str = """SELECT symbol_id, price_date, open_price, high_price, low_price, close_price, volume
+                        from securities_master.daily_price
+                        where """
+        params = []
+        if since is None:
+            select_str += "securities_master.daily_price.symbol_id IN (%s)" % ', '.join(['%s'] * len(locations))
+            params.extend(locations.values())
+            if self.start_date is not None:
+                select_str += " and securities_master.daily_price.price_date >= %s"
+                params.append(self.start_date)
+            if self.end_date is not None:
+                select_str += " and securities_master.daily_price.price_date <= %s"
+                params.append(self.end_date)
+        else:
+            clauses = []
+            for ticker, symbol_id in locations.items():
+                if since.get(ticker) is None:
+                    clauses.append("securities_master.daily_price.symbol_id = %s")
+                    params.append(symbol_id)
+                else:
+                    clauses.append("(securities_master.daily_price.symbol_id = %s"
+                                   " and securities_master.daily_price.price_date > %s)")
+                    params.extend([symbol_id, since[ticker].to_pydatetime()])
+            select_str += "(" + " or ".join(clauses) + ")"
+        select_str += " order by symbol_id, price_date"
+        con = self.get_connection()
+        try:
+            data = pd.read_sql_query(select_str, con, params=params)
+        finally:
+            con.close()
+        return data
+
+    def query_warmup(self, locations, n):
+        """
+        Runs a single query for the last n daily prices of every symbol ID in
+        locations before start_date, which derived series read back over.
+        """
+        select_str = """(SELECT symbol_id, price_date, open_price, high_price, low_price, close_price, volume
+                         from securities_master.daily_price
+                         where securities_master.daily_price.symbol_id = %s
+                         and securities_master.daily_price.price_date < %s
+                         order by price_date desc limit %s)"""
+        params = []
+        for symbol_id in locations.values():
+            params.extend([symbol_id, self.start_date, n])
+        con = self.get_connection()
+        try:
+            data = pd.read_sql_query(" UNION ALL ".join([select_str] * len(locations)), con, params=params)
+        finally:
+            con.close()
+        return data
+
+    def derived_warmup(self):
+        """
+        Returns the number of bars before start_date the registered derived
+        series need, the longest of their lookbacks.
+        """
+        return max([derived.warmup(kind, args) for kind, args in self.derived.values()] or [0])
+
+    def load_frames(self, locations):
+        """
+        Returns a dictionary of ticker to the raw daily prices of that symbol,
+        refreshing the local price cache first if one is configured.
+        Derived series are computed over the history before start_date as well,
+        so their values do not depend on whether the cache is used.
+        """
+        if self.cache is None:
+            data = self.query_prices(locations)
+            warmup = self.derived_warmup()
+            if warmup and self.start_date is not None:
+                data = pd.concat([self.query_warmup(locations, warmup), data], ignore_index=True)
+                data = data.sort_values(['symbol_id', 'price_date'], kind='mergesort')
+            grouped = dict(list(data.groupby('symbol_id', sort=False)))
+            frames = {}
+            for ticker, symbol_id in locations.items():
+                frame = grouped[symbol_id].reset_index(drop=True)
+                self.add_derived_series(frame)
+                if warmup and self.start_date is not None:
+                    keep = (pd.to_datetime(frame['price_date']) >= pd.Timestamp(self.start_date)).values
+                    frame = frame.loc[keep].reset_index(drop=True)
+                frames[ticker] = frame
+            return frames
+        since = {ticker: self.cache.last_date(ticker) for ticker in locations}
+        data = self.query_prices(locations, since)
+        tickers = {symbol_id: ticker for ticker, symbol_id in locations.items()}
+        for symbol_id, rows in data.groupby('symbol_id', sort=False):
+            self.cache.append(tickers[symbol_id], rows)
+        frames = {}
+        for ticker, symbol_id in locations.items():
+            # Derived series use the full cached history before the range is sliced
+            frame = self.cache.frame(ticker)
+            if frame is None:
+                raise KeyError("No prices stored for %s" % ticker)
+            self.add_derived_series(frame, ticker)
+            keep = np.ones(len(frame), dtype=bool)
+            if self.start_date is not None:
+                keep &= (frame['price_date'] >= pd.Timestamp(self.start_date)).values
+            if self.end_date is not None:
+                keep &= (frame['price_date'] <= pd.Timestamp(self.end_date)).values
+            frame = frame.loc[keep].reset_index(drop=True)
+            frame.insert(0, 'symbol_id', symbol_id)
+            frames[ticker] = frame
+        return frames
+
+    def register_series(self, kind, *args):
+        """
+        Declares a derived series, e.g. register_series('rolling_mean', 'close_price', 20),
+        computed once per symbol when the data is loaded and read back as a field
+        through get_latest_bars. Returns the field name of the series.
+        """
+        if self.chunk_size is not None:
+            raise ValueError("Derived series are not available when streaming bars")
+        name = derived.series_name(kind, args)
+        if self.store is not None:
+            if name in self.store.fields:
+                return name
+            raise ValueError("Derived series must be registered before the data is loaded")
+        if name not in self.derived:
+            self.derived[name] = (kind, args)
+            self.fields.append(name)
+        return name
+
+    def add_derived_series(self, frame, ticker=None):
+        """
+        Adds a column to the raw prices of a symbol for every registered
+        derived series, reading and writing the price cache when a ticker
+        is given.
+        """
+        for name, (kind, args) in self.derived.items():
+            values = None
+            if ticker is not None:
+                values = self.cache.load_series(ticker, name, len(frame))
+            if values is None:
+                values = derived.compute(frame, kind, args)
+                if ticker is not None:
+                    self.cache.save_series(ticker, name, values)
+            frame[name] = values
+
+    def invalidate_cache(self, symbol=None):
+        """
+        Drops the cached prices of a symbol, or of every symbol, so the
+        next load reads the full history from the database again.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(symbol)
+
     def get_prices(self, locations):
         """
         Makes use of the symbol_id list to return dataframes of the prices of those assets
         """
-        con = msc.connect(host=self.host, user=self.user, password=self.password, db=self.db_name)
+        frames = self.load_frames(locations)
         dataframes = []
-        for id in locations.keys():
-            select_str = """SELECT *
-                           from securities_master.daily_price
-                           where securities_master.daily_price.symbol_id = '%s'
-                        """ % locations[id]
-            data = pd.read_sql_query(select_str, con)
-            specific_data = data[
-                ['symbol_id', 'price_date', 'open_price', 'high_price', 'low_price', 'close_price', 'volume']]
-            specific_data.rename(columns={'symbol_id': id}, inplace=True)
-            specific_data['returns'] = specific_data['close_price'].pct_change()
-            specific_data['returns'].fillna(0, inplace=True)
+        for ticker in locations.keys():
+            specific_data = frames[ticker]
+            specific_data.rename(columns={'symbol_id': ticker}, inplace=True)
             dataframes.append(specific_data)
-        start_date = []
-        start = None
-        for package in dataframes:
-            start_date.append(package.iloc[1, 1])
-            start = max(start_date)
-        for i ,package in enumerate(dataframes):
-            dataframes[i] = package.loc[package['price_date'] >= start]
         return dataframes
 
-    def pull_data(self, price_type):
-        """
-         pulls data from the database based on the symbol
-         returns a list of dictionaries
-         """
-        tickers = self.get_prices_id()
-        data = self.get_prices(tickers)
-        choices = []
-        for package in data:
-            length = len(package[price_type])
-            choices.append(length)
-        loop = min(choices)
-        for i in range(0, loop):
-            day = []
-            for package in data:
-                name = package.columns[0]
-                constructor = {name: None, 'Date': None, 'returns': None}
-                package = package[[price_type, 'price_date', 'returns']]
-                constructor[name] = package.iloc[i, 0]
-                constructor['Date'] = package.iloc[i, 1]
-                constructor['returns'] = package.iloc[i, 2]
-                day.append(constructor)
-            self.symbol_data.append(day)
-        return self.symbol_data
-
-    def get_new_bar(self, price_type):
+    def pull_data(self, price_type='close_price'):
+        """
+        pulls every OHLCV field from the database based on the symbol
+        and loads it into a columnar bar_store. price_type is the field
+        returned by the latest bar methods when none is given
+        returns the bar_store
+        """
+        self.price_type = price_type
+        if self.store is None:
+            tickers = self.get_prices_id()
+            data = self.get_prices(tickers)
+            self.store = bar_store.from_frames(data, self.fields, self.fill_policy)
+        return self.store
+
+    def iter_symbol_rows(self, position, ticker, symbol_id):
+        """
+        Yields the daily prices of one symbol in date order as tuples of
+        (price_date, position, open, high, low, close, volume). Cached rows
+        are read from the memory mapped price_cache and newer rows are fetched
+        from the database chunk_size rows per query, so only one chunk of the
+        symbol is held in memory at a time.
+        """
+        last = None
+        if self.cache is not None:
+            data = self.cache.load(ticker)
+            if data is not None:
+                start, stop = self.cache.bounds(data, self.start_date, self.end_date)
+                # Only chunk_size rows of the memory mapped columns are read at a time
+                for begin in range(start, stop, self.chunk_size):
+                    end = min(begin + self.chunk_size, stop)
+                    chunk = [np.array(data[column][begin:end]) for column in self.cache.columns]
+                    for row in zip(*chunk):
+                        yield (pd.Timestamp(row[0]), position) + tuple(float(x) for x in row[1:])
+                if len(data['price_date']):
+                    last = pd.Timestamp(data['price_date'][-1])
+            if last is not None and self.end_date is not None and last >= pd.Timestamp(self.end_date):
+                return
+        select_str = """SELECT price_date, open_price, high_price, low_price, close_price, volume
+                        from securities_master.daily_price
+                        where securities_master.daily_price.symbol_id = %s"""
+        while True:
+            params = [symbol_id]
+            query = select_str
+            if last is not None:
+                query += " and securities_master.daily_price.price_date > %s"
+                params.append(last.to_pydatetime())
+            elif self.start_date is not None:
+                query += " and securities_master.daily_price.price_date >= %s"
+                params.append(self.start_date)
+            if self.end_date is not None:
+                query += " and securities_master.daily_price.price_date <= %s"
+                params.append(self.end_date)
+            query += " order by price_date limit %s"
+            params.append(self.chunk_size)
+            con = self.get_connection()
+            try:
+                cursor = con.cursor()
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+                cursor.close()
+            finally:
+                con.close()
+            for row in rows:
+                yield (pd.Timestamp(row[0]), position) + tuple(np.nan if x is None else float(x) for x in row[1:])
+            if len(rows) < self.chunk_size:
+                return
+            last = pd.Timestamp(rows[-1][0])
+
+    def stream_bars(self):
+        """
+        Merges the row streams of every symbol by date in a k-way streaming
+        merge and yields each day as soon as all of its rows have arrived.
+        Days are placed on the same master calendar and filled with the same
+        fill_policy as bar_store.from_frames, so both paths yield identical bars.
+        """
+        if self.fill_policy not in ('ffill', 'nan', 'skip'):
+            raise ValueError("Unknown fill policy %s" % self.fill_policy)
+        locations = self.get_prices_id()
+        streams = [self.iter_symbol_rows(i, ticker, symbol_id)
+                   for i, (ticker, symbol_id) in enumerate(locations.items())]
+        price_fields = self.fields[:5]
+        last = {field: np.full(len(locations), np.nan) for field in price_fields}
+        seen = np.zeros(len(locations), dtype=bool)
+        prev_close = None
+        for date, rows in itertools.groupby(heapq.merge(*streams), key=itemgetter(0)):
+            present = np.zeros(len(locations), dtype=bool)
+            for row in rows:
+                j = row[1]
+                present[j] = True
+                for k, field in enumerate(price_fields):
+                    last[field][j] = row[k + 2]
+            seen |= present
+            if self.fill_policy == 'skip':
+                if not present.all():
+                    continue
+            elif not seen.all():
+                continue
+            if self.fill_policy == 'nan':
+                bar = {field: np.where(present, values, np.nan) for field, values in last.items()}
+            else:
+                bar = {field: values.copy() for field, values in last.items()}
+                if self.fill_policy == 'ffill':
+                    bar['volume'][~present] = 0.0
+            close = bar['close_price']
+            if prev_close is not None:
+                bar['returns'] = close / prev_close - 1.0
+                yield date.to_datetime64(), bar
+            prev_close = close
+
+    def get_new_bar(self, price_type='close_price', start=0):
         """
         obtain the price one at a time to simulate a live trading experience
-        """
-        for b in self.pull_data(price_type):
-            yield b
-
-    def get_latest_bar(self):
-        """
-        Returns the last bar from the latest_symbol list.
-        """
-        try:
-            bars_list = self.latest_symbol_data[-1]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return bars_list
-
-    def get_latest_bar_value(self, symbol):
-        """Returns the latest bar values for a symbol
-        in the latest symbol data structure
-        """
-        dictionary = self.get_latest_bars(1)
-        return dictionary[symbol][-1]
-
-    def get_latest_bars(self, N):
-        """
-        Returns the last N bars from the latest_symbol list,
-        or N-k if less available.
-        """
-        try:
-            bars_dict = {}
-            for bar in  self.latest_symbol_data[0]:
-                bars_dict[list(bar.keys())[0]] = []
-            for day in self.latest_symbol_data[-N:]:
-                for bar in day:
-                    bars_dict[list(bar.keys())[0]].append(bar[list(bar.keys())[0]])
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return bars_dict
-
-    def get_latest_bars_datetime(self, N):
-        """
-        Returns a Python datetime object for the last bar.
-        """
-        try:
-            bars_list = []
-            for bar in self.latest_symbol_data[-N:]:
-                bars_list.append(bar[0]['Date'])
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return bars_list
+        yields the date and the values of each field for every symbol,
+        streamed from the database when chunk_size is set
+        start - The number of bars already handled, skipped when resuming
+        from a checkpoint
+        """
+        self.price_type = price_type
+        if self.chunk_size is not None:
+            for bar in itertools.islice(self.stream_bars(), start, None):
+                yield bar
+            return
+        store = self.pull_data(price_type)
+        for i in range(start, len(store)):
+            yield store.dates[i], {field: values[i] for field, values in store.fields.items()}
 
     def update_bars(self, price_type, gen, day):
         """
-        Pushes the latest bar to the latest_symbol_data structure
-        for symbol
+        Pushes the latest bar to the lookback buffer
+        for every symbol
         """
         try:
             bar = next(gen)
@@ -323,9 +765,9 @@ class securities_master_handler(data_handler):
             self.continue_backtest = False
         else:
             if bar is not None:
-                self.latest_symbol_data.append(bar)
-        self.events.put(market_event())
-        return self.latest_symbol_data
+                self.push_bar(*bar)
+        self.events.put(MARKET_EVENT)
+        return self.bar_index
 
 
 class strategy(object):
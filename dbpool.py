@@ -0,0 +1,38 @@
+import os
+import threading
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def get_pool(host, user, password, name, pool_size=2):
+    """
+    Returns the connection pool for a database, creating it on first
+    use. Nothing connects at import time, and pools are kept per process
+    so that forked workers never share the sockets of their parent.
+    Parameters:
+    host - The database host
+    user - The database user
+    password - The database password
+    name - The database name
+    pool_size - The number of pooled connections, used when the pool is created
+    """
+    key = (os.getpid(), host, user, name)
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            # Imported here so the engine can be imported without the driver
+            from mysql.connector import pooling
+            pool = pooling.MySQLConnectionPool(pool_name='securities_master_%d_%d' % (os.getpid(), len(_pools)),
+                                               pool_size=pool_size, host=host, user=user,
+                                               password=password, db=name)
+            _pools[key] = pool
+    return pool
+
+
+def get_connection(host, user, password, name, pool_size=2):
+    """
+    Returns a pooled connection to a database. Closing the
+    connection hands it back to the pool.
+    """
+    return get_pool(host, user, password, name, pool_size).get_connection()
@@ -0,0 +1,87 @@
+import numpy as np
+
+# Derived series are computed once per symbol from the raw daily prices
+# when a data handler loads its data. Every series only looks back, so
+# the value at a bar never depends on later bars.
+
+
+def log_returns(frame):
+    """
+    Returns the log returns of the close price.
+    """
+    return np.log(frame['close_price']).diff().values
+
+
+def rolling_mean(frame, field, window):
+    """
+    Returns the rolling mean of a field over window bars.
+    """
+    return frame[field].rolling(int(window)).mean().values
+
+
+def rolling_std(frame, field, window):
+    """
+    Returns the rolling sample standard deviation of a field over window bars.
+    """
+    return frame[field].rolling(int(window)).std().values
+
+
+def atr(frame, window):
+    """
+    Returns the average true range over window bars.
+    """
+    prev_close = frame['close_price'].shift(1)
+    true_range = np.maximum(frame['high_price'] - frame['low_price'],
+                            np.maximum((frame['high_price'] - prev_close).abs(),
+                                       (frame['low_price'] - prev_close).abs()))
+    return true_range.rolling(int(window)).mean().values
+
+
+def lagged_returns(frame, lag):
+    """
+    Returns the close to close returns lagged by lag bars.
+    """
+    return frame['close_price'].pct_change().shift(int(lag)).values
+
+
+series = {
+    'log_returns': log_returns,
+    'rolling_mean': rolling_mean,
+    'rolling_std': rolling_std,
+    'atr': atr,
+    'lagged_returns': lagged_returns
+}
+
+
+# The number of bars before the first one each series needs to be defined
+warmups = {
+    'log_returns': lambda: 1,
+    'rolling_mean': lambda field, window: int(window) - 1,
+    'rolling_std': lambda field, window: int(window) - 1,
+    'atr': lambda window: int(window),
+    'lagged_returns': lambda lag: int(lag) + 1
+}
+
+
+def warmup(kind, args):
+    """
+    Returns the number of earlier bars a derived series reads back, so the
+    series is the same whether or not the history before a date range is loaded.
+    """
+    return warmups[kind](*args)
+
+
+def series_name(kind, args):
+    """
+    Returns the field name of a derived series, e.g. rolling_mean_close_price_20.
+    """
+    if kind not in series:
+        raise ValueError("Unknown derived series %s" % kind)
+    return '_'.join([kind] + [str(arg) for arg in args])
+
+
+def compute(frame, kind, args):
+    """
+    Computes a derived series for the raw prices of one symbol.
+    """
+    return np.asarray(series[kind](frame, *args), dtype=np.float64)
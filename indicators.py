@@ -0,0 +1,201 @@
+from collections import deque
+import numpy as np
+
+
+class indicator(object):
+    """
+    Indicator is an abstract base class for incremental indicators.
+    A data handler calls update once per bar with the values of a field
+    for every symbol, and strategies read the current value of every
+    symbol from the value array in O(1), whatever the window length.
+    """
+    name = None
+
+    def __init__(self):
+        self.value = None
+
+    def update(self, values):
+        """
+        Updates the indicator with the latest values of every symbol.
+        """
+        raise NotImplementedError("Should implement update()")
+
+
+class simple_moving_average(indicator):
+    """
+    Mean of the last window values, or of every value seen while fewer
+    are available. A window holding a NaN has a NaN mean. The running
+    sum is recomputed each time the window wraps, so it does not drift.
+    """
+    def __init__(self, window):
+        indicator.__init__(self)
+        self.window = window
+        self.name = 'sma_%d' % window
+        self.history = None
+        self.pos = 0
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.history is None:
+            self.history = np.zeros((self.window, len(values)))
+            self.missing = np.zeros((self.window, len(values)), dtype=bool)
+            self.total = np.zeros(len(values))
+            self.gaps = np.zeros(len(values), dtype=np.int64)
+        missing = np.isnan(values)
+        clean = np.where(missing, 0.0, values)
+        if self.count == self.window:
+            self.total -= self.history[self.pos]
+            self.gaps -= self.missing[self.pos]
+        else:
+            self.count += 1
+        self.history[self.pos] = clean
+        self.missing[self.pos] = missing
+        self.total += clean
+        self.gaps += missing
+        self.pos = (self.pos + 1) % self.window
+        if self.pos == 0:
+            self.total = self.history.sum(axis=0)
+        self.value = np.where(self.gaps > 0, np.nan, self.total / self.count)
+        return self.value
+
+
+class exponential_moving_average(indicator):
+    """
+    Exponential moving average with smoothing 2 / (span + 1), seeded with
+    the first value of each symbol. NaN values leave the average unchanged.
+    """
+    def __init__(self, span):
+        indicator.__init__(self)
+        self.span = span
+        self.alpha = 2.0 / (span + 1.0)
+        self.name = 'ema_%d' % span
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.value is None:
+            self.value = values.copy()
+        else:
+            blended = self.alpha * values + (1.0 - self.alpha) * self.value
+            self.value = np.where(np.isnan(values), self.value, np.where(np.isnan(self.value), values, blended))
+        return self.value
+
+
+class rolling_variance(indicator):
+    """
+    Sample variance of the last window values using Welford's algorithm,
+    adding the newest value and removing the one leaving the window.
+    NaN values are left out of the window.
+    """
+    def __init__(self, window):
+        indicator.__init__(self)
+        self.window = window
+        self.name = 'var_%d' % window
+        self.history = None
+        self.pos = 0
+        self.full = False
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.history is None:
+            self.history = np.full((self.window, len(values)), np.nan)
+            self.n = np.zeros(len(values))
+            self.mean = np.zeros(len(values))
+            self.m2 = np.zeros(len(values))
+        if self.full:
+            old = self.history[self.pos]
+            leaving = ~np.isnan(old)
+            n = self.n - leaving
+            safe = np.where(n > 0, n, 1.0)
+            delta = np.where(leaving, old - self.mean, 0.0)
+            mean = np.where(n > 0, self.mean - delta / safe, 0.0)
+            self.m2 = np.where(n > 0, self.m2 - delta * np.where(leaving, old - mean, 0.0), 0.0)
+            self.n = n
+            self.mean = mean
+        entering = ~np.isnan(values)
+        self.n = self.n + entering
+        delta = np.where(entering, values - self.mean, 0.0)
+        self.mean = self.mean + np.where(entering, delta / np.where(self.n > 0, self.n, 1.0), 0.0)
+        self.m2 = self.m2 + delta * np.where(entering, values - self.mean, 0.0)
+        self.history[self.pos] = values
+        self.pos = (self.pos + 1) % self.window
+        if self.pos == 0:
+            self.full = True
+        self.value = np.where(self.n > 1, np.maximum(self.m2, 0.0) / np.where(self.n > 1, self.n - 1, 1.0), np.nan)
+        return self.value
+
+    @property
+    def std(self):
+        return np.sqrt(self.value)
+
+
+class rolling_extreme(indicator):
+    """
+    Maximum or minimum of the last window values, kept with one monotonic
+    deque per symbol so each update costs amortized O(1) per symbol.
+    NaN values are skipped.
+    """
+    def __init__(self, window, highest=True):
+        indicator.__init__(self)
+        self.window = window
+        self.highest = highest
+        self.name = '%s_%d' % ('max' if highest else 'min', window)
+        self.deques = None
+        self.bar = -1
+
+    def update(self, values):
+        self.bar += 1
+        if self.deques is None:
+            self.deques = [deque() for _ in range(len(values))]
+            self.value = np.full(len(values), np.nan)
+        oldest = self.bar - self.window
+        for j, x in enumerate(values):
+            window = self.deques[j]
+            if x == x:
+                if self.highest:
+                    while window and window[-1][1] <= x:
+                        window.pop()
+                else:
+                    while window and window[-1][1] >= x:
+                        window.pop()
+                window.append((self.bar, x))
+            while window and window[0][0] <= oldest:
+                window.popleft()
+            self.value[j] = window[0][1] if window else np.nan
+        return self.value
+
+
+class rolling_max(rolling_extreme):
+    def __init__(self, window):
+        rolling_extreme.__init__(self, window, True)
+
+
+class rolling_min(rolling_extreme):
+    def __init__(self, window):
+        rolling_extreme.__init__(self, window, False)
+
+
+class crossover(indicator):
+    """
+    Detects a fast indicator crossing a slow one. The value is 1 on the
+    bar the fast one moves above the slow one, -1 on the bar it moves
+    below and 0 otherwise. It must be registered after both indicators
+    so it reads their values of the same bar.
+    """
+    def __init__(self, fast, slow):
+        indicator.__init__(self)
+        self.fast = fast
+        self.slow = slow
+        self.name = 'cross_%s_%s' % (fast.name, slow.name)
+        self.above = None
+
+    def update(self, values=None):
+        above = self.fast.value > self.slow.value
+        below = self.fast.value < self.slow.value
+        if self.above is None:
+            self.value = np.zeros(len(above), dtype=np.int64)
+            self.above = above
+        else:
+            self.value = np.where(above & ~self.above, 1, np.where(below & self.above, -1, 0))
+            self.above = np.where(above | below, above, self.above)
+        return self.value
@@ -0,0 +1,81 @@
+import time
+import pandas as pd
+
+
+class backtest_profiler(object):
+    """
+    Records the wall time and call count of each component of the
+    backtest loop, the depth of the event queue on every bar and the
+    overall throughput, without printing anything during the run.
+    """
+    def __init__(self):
+        self.timings = {}
+        self.calls = {}
+        self.queue_depth = []
+        self.bars = 0
+        self.start_time = None
+        self.end_time = None
+
+    def wrap(self, name, func):
+        """
+        Returns func wrapped so that every call is timed under name.
+        """
+        self.timings.setdefault(name, 0.0)
+        self.calls.setdefault(name, 0)
+        timings = self.timings
+        calls = self.calls
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[name] += clock() - start
+                calls[name] += 1
+        return timed
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        self.end_time = time.perf_counter()
+
+    def record_bar(self, depth):
+        """
+        Records a completed bar and the largest queue depth seen during it.
+        """
+        self.bars += 1
+        self.queue_depth.append(depth)
+
+    def report(self):
+        """
+        Returns a dictionary of the elapsed time, throughput, queue depth
+        statistics and the per component timings of the run.
+        """
+        end = self.end_time if self.end_time is not None else time.perf_counter()
+        elapsed = end - self.start_time if self.start_time is not None else 0.0
+        components = {}
+        for name, total in self.timings.items():
+            calls = self.calls[name]
+            components[name] = {
+                'calls': calls,
+                'total_time': total,
+                'mean_time': total / calls if calls else 0.0,
+                'share': total / elapsed if elapsed else 0.0
+            }
+        depth = self.queue_depth
+        return {
+            'bars': self.bars,
+            'elapsed': elapsed,
+            'bars_per_second': self.bars / elapsed if elapsed else 0.0,
+            'mean_queue_depth': sum(depth) / len(depth) if depth else 0.0,
+            'max_queue_depth': max(depth) if depth else 0,
+            'components': components
+        }
+
+    def report_frame(self):
+        """
+        Returns the per component timings as a pandas DataFrame.
+        """
+        return pd.DataFrame(self.report()['components']).T
@@ -0,0 +1,369 @@
+import itertools
+import json
+import os
+import struct
+import numpy as np
+import pandas as pd
+from dataeventhandler import buffered_data_handler, strategy, signal_event, order_event, fill_event, MARKET_EVENT
+
+# Journal files start with MAGIC followed by the byte length and text of
+# a JSON header holding the schema, then one binary record per event
+MAGIC = b'BTJ1'
+JOURNAL_VERSION = 1
+
+MARKET = 1
+SIGNAL = 2
+ORDER = 3
+FILL = 4
+
+SIGNAL_CODES = {'LONG': 1, 'SHORT': -1, 'EXIT': 2}
+DIRECTION_CODES = {'BUY': 1, 'SELL': -1}
+ORDER_TYPE_CODES = {'MKT': 0, 'LMT': 1}
+
+# Datetimes are stored as nanoseconds since the epoch, NAT standing for None
+NAT = np.iinfo(np.int64).min
+
+
+def record_formats(n_symbols):
+    """
+    Returns the struct format of each record type, following the one byte
+    record tag. Fill records end with the exchange as a length prefixed
+    UTF-8 string.
+    MARKET - date, 1 if a new bar was pushed, price of every symbol
+    SIGNAL - session, symbol, signal type, strength, strategy id, datetime
+    ORDER - session, symbol, order type, quantity, direction
+    FILL - session, symbol, quantity, direction, fill cost, commission, time index, exchange length
+    """
+    return {
+        MARKET: '<qB%dd' % n_symbols,
+        SIGNAL: '<HHbdqq',
+        ORDER: '<HHbqb',
+        FILL: '<HHqbddqB'
+    }
+
+
+def to_ns(value):
+    if value is None:
+        return NAT
+    return pd.Timestamp(value).value
+
+
+def from_ns(value):
+    if value == NAT:
+        return None
+    return pd.Timestamp(value).to_pydatetime()
+
+
+def invert(codes):
+    return {code: name for name, code in codes.items()}
+
+
+class event_journal(object):
+    """
+    Append-only binary journal of the MARKET, SIGNAL, ORDER and FILL events
+    of a backtest. Each record is a fixed layout struct described by the
+    schema in the header, so a journal can be read back without the code
+    that wrote it, replayed with journal_handler or compared with diff_journals.
+    """
+    def __init__(self, path, symbols, price_type, initial_capital, start_date, strategies, append=False,
+                 offset=None):
+        """
+        Parameters:
+        path - The journal file.
+        symbols - The symbols of the backtest, records refer to them by index.
+        price_type - The field whose values MARKET records carry.
+        initial_capital, start_date - The portfolio settings, kept for replays.
+        strategies - The names of the strategy of every session.
+        append - Appends to an existing journal, e.g. when resuming from a checkpoint.
+        offset - The size of the journal when the checkpoint was saved. The records
+        written after it by the run that was stopped, possibly ending with a half
+        written one, are cut off before appending.
+        """
+        self.path = path
+        self.symbols = list(symbols)
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.formats = record_formats(len(self.symbols))
+        self.structs = {tag: struct.Struct(fmt) for tag, fmt in self.formats.items()}
+        self.last_bar = None
+        if append and os.path.exists(path):
+            header = journal_header(path)
+            if header['symbols'] != self.symbols or header['strategies'] != list(strategies) \
+                    or header['price_type'] != price_type:
+                raise ValueError("The journal %s was recorded for another backtest" % path)
+            self.file = open(path, 'r+b', buffering=1 << 20)
+            if offset is not None:
+                self.file.truncate(offset)
+            self.file.seek(0, os.SEEK_END)
+            return
+        header = {
+            'version': JOURNAL_VERSION,
+            'symbols': self.symbols,
+            'price_type': price_type,
+            'initial_capital': initial_capital,
+            'start_date': None if start_date is None else pd.Timestamp(start_date).isoformat(),
+            'strategies': list(strategies),
+            'records': {'MARKET': MARKET, 'SIGNAL': SIGNAL, 'ORDER': ORDER, 'FILL': FILL},
+            'formats': {str(tag): fmt for tag, fmt in self.formats.items()},
+            'signal_codes': SIGNAL_CODES,
+            'direction_codes': DIRECTION_CODES,
+            'order_type_codes': ORDER_TYPE_CODES
+        }
+        text = json.dumps(header).encode('utf-8')
+        self.file = open(path, 'wb', buffering=1 << 20)
+        self.file.write(MAGIC + struct.pack('<I', len(text)) + text)
+
+    def write_market(self, bars):
+        """
+        Records a MARKET event with the latest bar of a data handler.
+        """
+        prices = bars.get_latest_bar_values()
+        if prices is None:
+            return
+        new_bar = bars.bar_index != self.last_bar
+        self.last_bar = bars.bar_index
+        self.file.write(bytes([MARKET]) + self.structs[MARKET].pack(to_ns(bars.get_latest_bars_datetime(1)[-1]),
+                                                                     new_bar, *prices))
+
+    def write(self, session, event):
+        """
+        Records a SIGNAL, ORDER or FILL event of a strategy session.
+        """
+        j = self.symbol_index[event.symbol]
+        if event.type == 'SIGNAL':
+            record = self.structs[SIGNAL].pack(session, j, SIGNAL_CODES[event.signal_type], event.strength,
+                                               event.strategy_id, to_ns(event.datetime))
+        elif event.type == 'ORDER':
+            record = self.structs[ORDER].pack(session, j, ORDER_TYPE_CODES[event.order_type], event.quantity,
+                                              DIRECTION_CODES[event.direction])
+        else:
+            exchange = (event.exchange or '').encode('utf-8')
+            fill_cost = np.nan if event.fill_cost is None else event.fill_cost
+            record = self.structs[FILL].pack(session, j, event.quantity, DIRECTION_CODES[event.direction],
+                                             fill_cost, event.commission, to_ns(event.time_index),
+                                             len(exchange)) + exchange
+        self.file.write(bytes([{'SIGNAL': SIGNAL, 'ORDER': ORDER, 'FILL': FILL}[event.type]]) + record)
+
+    def wrap(self, session, func):
+        """
+        Returns func recording each event of a session before handling it.
+        """
+        write = self.write
+
+        def recorded(event):
+            write(session, event)
+            return func(event)
+        return recorded
+
+    def offset(self):
+        """
+        Flushes the journal and returns its size in bytes, saved with
+        checkpoints to cut the journal back to on resume.
+        """
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def read_header(f):
+    """
+    Reads the header of a journal opened in binary mode.
+    """
+    if f.read(4) != MAGIC:
+        raise ValueError("Not an event journal")
+    size = struct.unpack('<I', f.read(4))[0]
+    header = json.loads(f.read(size).decode('utf-8'))
+    if header['version'] != JOURNAL_VERSION:
+        raise ValueError("Unsupported journal version %s" % header['version'])
+    return header
+
+
+def journal_header(path):
+    """
+    Returns the header of the journal at path.
+    """
+    with open(path, 'rb') as f:
+        return read_header(f)
+
+
+def read_journal(path):
+    """
+    Yields the records of a journal in order as tuples of
+    (record type name, session, fields), MARKET records having no session
+    and carrying (date, new bar, prices) and the other records their
+    event object. A truncated last record, left by a killed run, is ignored.
+    """
+    with open(path, 'rb') as f:
+        header = read_header(f)
+        symbols = header['symbols']
+        structs = {int(tag): struct.Struct(fmt) for tag, fmt in header['formats'].items()}
+        signal_types = invert(header['signal_codes'])
+        directions = invert(header['direction_codes'])
+        order_types = invert(header['order_type_codes'])
+        while True:
+            tag = f.read(1)
+            if not tag:
+                return
+            tag = tag[0]
+            record = structs[tag]
+            data = f.read(record.size)
+            if len(data) < record.size:
+                return
+            values = record.unpack(data)
+            if tag == MARKET:
+                prices = np.array(values[2:], dtype=np.float64)
+                yield 'MARKET', None, (np.datetime64(values[0], 'ns'), bool(values[1]), prices)
+            elif tag == SIGNAL:
+                session, j, code, strength, strategy_id, dt = values
+                yield 'SIGNAL', session, signal_event(strategy_id, symbols[j], from_ns(dt), signal_types[code],
+                                                      strength)
+            elif tag == ORDER:
+                session, j, code, quantity, direction = values
+                yield 'ORDER', session, order_event(symbols[j], order_types[code], quantity, directions[direction])
+            else:
+                session, j, quantity, direction, fill_cost, commission, time_index, length = values
+                exchange = f.read(length)
+                if len(exchange) < length:
+                    return
+                yield 'FILL', session, fill_event(from_ns(time_index), symbols[j], exchange.decode('utf-8'),
+                                                  quantity, directions[direction],
+                                                  None if np.isnan(fill_cost) else fill_cost, commission)
+
+
+def record_values(kind, fields, timestamps=False):
+    """
+    Returns the comparable values of a record, leaving out the wall clock
+    timestamps of signals and fills unless timestamps is set.
+    """
+    if kind == 'MARKET':
+        date, new_bar, prices = fields
+        return (date, new_bar, tuple(prices))
+    names = fields.__slots__
+    if not timestamps:
+        names = [name for name in names if name not in ('datetime', 'time_index')]
+    return tuple(getattr(fields, name) for name in names)
+
+
+def diff_journals(path_a, path_b, limit=10, timestamps=False, rtol=1e-9, atol=1e-9):
+    """
+    Compares two journals event by event, e.g. written by two versions of
+    the engine, and returns up to limit differences as tuples of
+    (record number, record of a, record of b), a record being None past
+    the end of its journal. Prices and costs are compared within rtol and atol.
+    """
+    differences = []
+    pairs = itertools.zip_longest(read_journal(path_a), read_journal(path_b))
+    for n, (a, b) in enumerate(pairs):
+        if a is None or b is None or a[0] != b[0] or a[1] != b[1]:
+            same = False
+        else:
+            same = True
+            for x, y in zip(record_values(a[0], a[2], timestamps), record_values(b[0], b[2], timestamps)):
+                if isinstance(x, tuple) or isinstance(x, float):
+                    if not np.allclose(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                                       rtol=rtol, atol=atol, equal_nan=True):
+                        same = False
+                elif x != y:
+                    same = False
+        if not same:
+            differences.append((n, a, b))
+            if len(differences) >= limit:
+                break
+    return differences
+
+
+class journal_handler(buffered_data_handler):
+    """
+    journal_handler replays the bars of an event journal, holding the
+    recorded price_type values only, together with the signals recorded
+    on each bar, which recorded_strategy sends again. Nothing is read
+    from the database and no signal is recomputed.
+    """
+    def __init__(self, events, symbols, host=None, user=None, password=None, name=None, start_date=None,
+                 end_date=None, path=None):
+        """
+        Parameters:
+            events - The event queue
+            symbols - The list of ticker symbols, which must be those of the journal
+            path - The journal file
+        The database arguments are accepted for compatibility with Backtest and ignored.
+        """
+        self.path = path
+        self.header = journal_header(path)
+        if list(symbols) != self.header['symbols']:
+            raise ValueError("The journal was recorded for the symbols %s" % self.header['symbols'])
+        buffered_data_handler.__init__(self, events, symbols, [self.header['price_type']])
+        self.price_type = self.header['price_type']
+        self.signals = {}
+
+    def get_new_bar(self, price_type='close_price', start=0):
+        """
+        Yields the recorded bars as tuples of (date, new bar, prices,
+        signals), signals mapping each session to the signals it handled
+        on the bar.
+        start - The number of bars already handled, skipped when resuming
+        from a checkpoint
+        """
+        if price_type != self.price_type:
+            raise ValueError("The journal holds %s values only" % self.price_type)
+        return itertools.islice(self.iter_bars(), start, None)
+
+    def iter_bars(self):
+        bar = None
+        for kind, session, fields in read_journal(self.path):
+            if kind == 'MARKET':
+                if bar is not None:
+                    yield bar
+                bar = fields + ({},)
+            elif kind == 'SIGNAL' and bar is not None:
+                bar[3].setdefault(session, []).append(fields)
+        if bar is not None:
+            yield bar
+
+    def update_bars(self, price_type, gen, day):
+        """
+        Pushes the next recorded bar to the lookback buffer, ending the
+        backtest where the recorded one ended.
+        """
+        self.signals = {}
+        try:
+            date, new_bar, prices, signals = next(gen)
+        except StopIteration:
+            self.continue_backtest = False
+        else:
+            self.signals = signals
+            if new_bar:
+                self.push_bar(date, {self.price_type: prices})
+            else:
+                self.continue_backtest = False
+        self.events.put(MARKET_EVENT)
+        return self.bar_index
+
+    def recorded_signals(self, session):
+        """
+        Returns the signals a session handled on the latest bar.
+        """
+        return self.signals.get(session, [])
+
+
+class recorded_strategy(strategy):
+    """
+    Sends the signals recorded in a journal for one session instead
+    of calculating them.
+    """
+    def __init__(self, bars, events, session=0):
+        """
+        Parameters:
+        bars - A journal_handler.
+        events - The Event Queue object.
+        session - The recorded session whose signals are sent.
+        """
+        self.bars = bars
+        self.events = events
+        self.session = session
+
+    def calculate_signals(self, event):
+        if event.type == 'MARKET':
+            for signal in self.bars.recorded_signals(self.session):
+                self.events.put(signal)
@@ -0,0 +1,466 @@
+import asyncio
+from collections import deque
+import datetime
+import functools
+import json
+import time
+import numpy as np
+from backtest import strategy_session
+from dataeventhandler import buffered_data_handler, event_bus, fill_event, MARKET_EVENT
+from executionhandler import ExecutionHandler
+
+# A broker connects the live_engine to a market. It provides
+#   connect(on_bar, on_order_status) - coroutine opening the connection, after
+#       which on_bar(symbol, date, values) and on_order_status(order_id, status,
+#       filled, avg_fill_price) are called on the event loop as messages arrive
+#   subscribe(symbols) - coroutine requesting the bars of the symbols
+#   place_order(order) - sends an order_event without waiting and returns its id
+#   bar_done() - tells the broker a bar has been handled
+#   wait_closed() - coroutine returning once the broker closes the connection
+#   close() - closes the connection
+
+LIVE_FIELDS = ['open_price', 'high_price', 'low_price', 'close_price', 'volume', 'returns']
+
+
+class live_data_handler(buffered_data_handler):
+    """
+    live_data_handler assembles the bars a broker sends one symbol at a
+    time into bars of every symbol. A bar is pushed, and a MARKET event put
+    on the queue, as soon as every symbol has reported the date, or when a
+    later date arrives first, in which case missing symbols keep their
+    previous values with no volume, as the 'ffill' fill policy does.
+    """
+    def __init__(self, events, symbols, fields=None):
+        """
+        Parameters:
+            events - The event queue
+            symbols - The list of ticker symbols
+            fields - The names of the fields held for each bar
+        """
+        buffered_data_handler.__init__(self, events, symbols, list(fields or LIVE_FIELDS))
+        self.symbol_index = {symbol: j for j, symbol in enumerate(symbols)}
+        self.last = {field: np.full(len(symbols), np.nan) for field in self.fields}
+        self.present = np.zeros(len(symbols), dtype=bool)
+        self.given_returns = np.zeros(len(symbols), dtype=bool)
+        self.prev_close = None
+        self.pending_date = None
+
+    def on_bar(self, symbol, date, values):
+        """
+        Records the bar of one symbol, given as a dictionary of field to value.
+        Returns whether a bar of every symbol was pushed.
+        """
+        date = np.datetime64(date, 'ns')
+        pushed = False
+        if self.pending_date is not None and date != self.pending_date:
+            if date < self.pending_date:
+                return False
+            self.flush()
+            pushed = True
+        j = self.symbol_index[symbol]
+        self.pending_date = date
+        self.present[j] = True
+        self.given_returns[j] = 'returns' in values
+        for field, value in values.items():
+            if field in self.last:
+                self.last[field][j] = np.nan if value is None else value
+        if self.present.all():
+            self.flush()
+            pushed = True
+        return pushed
+
+    def flush(self):
+        """
+        Pushes the pending bar and puts a MARKET event on the queue.
+        """
+        row = {field: values.copy() for field, values in self.last.items()}
+        if 'volume' in row:
+            row['volume'][~self.present] = 0.0
+        close = row.get('close_price')
+        if 'returns' in row and close is not None:
+            computed = close / self.prev_close - 1.0 if self.prev_close is not None else np.full(len(close), np.nan)
+            row['returns'] = np.where(self.given_returns, row['returns'], computed)
+        self.prev_close = close
+        self.push_bar(self.pending_date, row)
+        self.present[:] = False
+        self.given_returns[:] = False
+        self.pending_date = None
+        self.events.put(MARKET_EVENT)
+
+    def update_bars(self, price_type, gen, day):
+        """
+        Bars are pushed by on_bar as the broker sends them.
+        """
+        return self.bar_index
+
+
+class broker_execution_handler(ExecutionHandler):
+    """
+    Sends orders to a broker without waiting and turns the order status
+    callbacks of filled orders into fill events.
+    """
+    def __init__(self, events, broker=None):
+        """
+        Parameters:
+        events - The Queue of Event objects.
+        broker - The broker orders are sent to.
+        """
+        self.events = events
+        self.broker = broker
+        self.pending = {}
+
+    def execute_order(self, event):
+        if event.type == 'ORDER':
+            order_id = self.broker.place_order(event)
+            self.pending[order_id] = event
+
+    def on_order_status(self, order_id, status, filled, avg_fill_price):
+        """
+        Puts a fill event on the queue once an order of this handler is
+        filled. Returns whether the order was placed by this handler.
+        """
+        if order_id not in self.pending:
+            return False
+        if status == 'Filled':
+            order = self.pending.pop(order_id)
+            self.events.put(fill_event(datetime.datetime.now(), order.symbol, getattr(self.broker, 'exchange', None),
+                                       filled, order.direction, avg_fill_price))
+        elif status in ('Cancelled', 'ApiCancelled', 'Inactive', 'Rejected'):
+            del self.pending[order_id]
+        return True
+
+
+class live_engine(object):
+    """
+    Runs strategies live on an asyncio event loop. Bars and order status
+    updates are handled by callbacks as soon as the broker delivers them,
+    and go through the same strategy, portfolio and execution interfaces
+    as a Backtest, with one strategy_session per strategy. Nothing waits on
+    a fixed sleep, so tick-to-order latency only depends on the handlers,
+    and is recorded for every bar.
+    """
+    def __init__(self, symbols, broker, initial_capital, start_date, portfolio, strategy, fields=None,
+                 max_latencies=100000):
+        """
+        Parameters:
+        symbols - The list of ticker symbols traded.
+        broker - The broker providing bars and executing orders.
+        initial_capital - The starting capital in USD.
+        start_date - The datetime of the initial holdings.
+        portfolio, strategy - The portfolio class and the strategy class, or list of them.
+        fields - The fields of the bars, LIVE_FIELDS by default.
+        max_latencies - The number of latest bar latencies kept.
+        """
+        self.symbols = symbols
+        self.broker = broker
+        self.events = event_bus()
+        self.data_handler = live_data_handler(self.events, symbols, fields)
+        execution_handler = functools.partial(broker_execution_handler, broker=broker)
+        strategies = strategy if isinstance(strategy, (list, tuple)) else [strategy]
+        self.sessions = [strategy_session(self.data_handler, event_bus(), execution_handler, portfolio, strat,
+                                          start_date, symbols, initial_capital)
+                         for strat in strategies]
+        self.dispatch = [(session, session.create_dispatch()) for session in self.sessions]
+        self.portfolio = self.sessions[0].portfolio
+        self.strategy = self.sessions[0].strategy
+        self.latencies = deque(maxlen=max_latencies)
+
+    def on_bar(self, symbol, date, values):
+        """
+        Handles the bar of one symbol, sending a MARKET event to every
+        session once a bar of every symbol is complete.
+        """
+        start = time.perf_counter()
+        self.data_handler.on_bar(symbol, date, values)
+        events = self.events
+        while events:
+            event = events.popleft()
+            for session, dispatch in self.dispatch:
+                dispatch[event.type](event)
+                session.drain(dispatch)
+            self.latencies.append(time.perf_counter() - start)
+            self.broker.bar_done()
+
+    def on_order_status(self, order_id, status, filled, avg_fill_price):
+        """
+        Hands an order status update to the session that placed the order.
+        """
+        for session, dispatch in self.dispatch:
+            if session.execution_handler.on_order_status(order_id, status, filled, avg_fill_price):
+                session.drain(dispatch)
+                break
+
+    async def run(self):
+        """
+        Connects to the broker, subscribes to the symbols and trades until
+        the broker closes the connection.
+        """
+        await self.broker.connect(self.on_bar, self.on_order_status)
+        try:
+            await self.broker.subscribe(self.symbols)
+            await self.broker.wait_closed()
+        finally:
+            self.broker.close()
+
+    def latency_report(self):
+        """
+        Returns statistics of the time, in microseconds, from receiving
+        the last symbol of a bar to handling every event it caused.
+        """
+        if not self.latencies:
+            return None
+        latencies = np.array(self.latencies) * 1e6
+        return {
+            'bars': len(latencies),
+            'mean': latencies.mean(),
+            'median': np.percentile(latencies, 50),
+            'p99': np.percentile(latencies, 99),
+            'max': latencies.max()
+        }
+
+
+def send_message(writer, message):
+    writer.write((json.dumps(message) + '\n').encode('utf-8'))
+
+
+class socket_broker(object):
+    """
+    Broker speaking newline delimited JSON over TCP, as served by
+    simulated_broker. Messages sent are subscribe, order and ack, and
+    messages received are bar, status and end.
+    """
+    exchange = 'SIM'
+
+    def __init__(self, host='127.0.0.1', port=7400):
+        self.host = host
+        self.port = port
+        self.next_id = 1
+        self.writer = None
+
+    async def connect(self, on_bar, on_order_status):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.on_bar = on_bar
+        self.on_order_status = on_order_status
+        self.closed = asyncio.get_running_loop().create_future()
+        self.listener = asyncio.ensure_future(self.listen())
+
+    async def listen(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                kind = message['type']
+                if kind == 'bar':
+                    self.on_bar(message['symbol'], np.datetime64(message['date'], 'ns'), message['values'])
+                elif kind == 'status':
+                    self.on_order_status(message['id'], message['status'], message['filled'],
+                                         message['avg_fill_price'])
+                elif kind == 'end':
+                    break
+        finally:
+            if not self.closed.done():
+                self.closed.set_result(True)
+
+    async def subscribe(self, symbols):
+        send_message(self.writer, {'type': 'subscribe', 'symbols': list(symbols)})
+        await self.writer.drain()
+
+    def place_order(self, order):
+        order_id = self.next_id
+        self.next_id += 1
+        send_message(self.writer, {'type': 'order', 'id': order_id, 'symbol': order.symbol,
+                                   'order_type': order.order_type, 'quantity': order.quantity,
+                                   'direction': order.direction})
+        return order_id
+
+    def bar_done(self):
+        send_message(self.writer, {'type': 'ack'})
+
+    async def wait_closed(self):
+        await self.closed
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class simulated_broker(object):
+    """
+    Local broker endpoint for testing the live engine against. It streams
+    the bars of a bar_store to every subscribed client and fills market
+    orders at the latest price of their symbol. In lockstep the next bar is
+    only sent once the client acknowledges the previous one, so the orders
+    of a bar are filled at its prices, as in a backtest.
+    """
+    def __init__(self, store, host='127.0.0.1', port=0, interval=0.0, lockstep=True, price_type='close_price'):
+        """
+        Parameters:
+        store - The bar_store streamed.
+        host, port - The address served, port 0 picking a free port.
+        interval - The seconds between two bars.
+        lockstep - Waits for the acknowledgement of each bar before the next.
+        price_type - The field orders are filled at.
+        """
+        self.store = store
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.lockstep = lockstep
+        self.price_type = price_type
+        self.server = None
+        self.clients = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def handle_client(self, reader, writer):
+        self.clients.add(asyncio.current_task())
+        acks = asyncio.Queue()
+        last = {}
+        stream = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                kind = message['type']
+                if kind == 'subscribe':
+                    stream = asyncio.ensure_future(self.stream(writer, message['symbols'], acks, last))
+                elif kind == 'order':
+                    price = last.get(message['symbol'], np.nan)
+                    send_message(writer, {'type': 'status', 'id': message['id'], 'status': 'Filled',
+                                          'filled': message['quantity'], 'avg_fill_price': price})
+                elif kind == 'ack':
+                    acks.put_nowait(True)
+        except ConnectionError:
+            pass
+        finally:
+            if stream is not None:
+                stream.cancel()
+            writer.close()
+            self.clients.discard(asyncio.current_task())
+
+    async def stream(self, writer, symbols, acks, last):
+        store = self.store
+        columns = [store.symbols.index(symbol) for symbol in symbols]
+        for i in range(len(store)):
+            date = str(store.dates[i])
+            for symbol, j in zip(symbols, columns):
+                values = {field: float(array[i, j]) for field, array in store.fields.items()}
+                last[symbol] = values[self.price_type]
+                send_message(writer, {'type': 'bar', 'symbol': symbol, 'date': date, 'values': values})
+            await writer.drain()
+            if self.lockstep:
+                await acks.get()
+            if self.interval:
+                await asyncio.sleep(self.interval)
+        send_message(writer, {'type': 'end'})
+        await writer.drain()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def wait_closed(self):
+        """
+        Waits for the clients to disconnect once the server is closed.
+        """
+        await asyncio.gather(*self.clients)
+
+
+class ib_broker(object):
+    """
+    Connects the live engine to Interactive Brokers through one IBdatafeed
+    client used for both five second real time bars and orders. The ibapi
+    callbacks arrive on its reader thread and are handed to the event loop
+    with call_soon_threadsafe. ibapi is only imported when connecting.
+    """
+    exchange = 'SMART'
+
+    def __init__(self, host='127.0.0.1', port=7497, client_id=10, what_to_show='TRADES', sec_type='STK'):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.what_to_show = what_to_show
+        self.sec_type = sec_type
+        self.app = None
+
+    async def connect(self, on_bar, on_order_status):
+        from IBdatafeed import IBdatafeed
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.on_bar = on_bar
+        self.closed = loop.create_future()
+        ready = loop.create_future()
+        self.app = IBdatafeed()
+        self.app.on_next_valid_id = lambda order_id: loop.call_soon_threadsafe(self.set_next_id, ready, order_id)
+        self.app.on_realtime_bar = lambda *bar: loop.call_soon_threadsafe(self.handle_bar, *bar)
+        self.app.on_order_status = lambda order_id, status, filled, avg_fill_price: loop.call_soon_threadsafe(
+            on_order_status, order_id, status, float(filled), avg_fill_price)
+        self.app.on_connection_closed = lambda: loop.call_soon_threadsafe(self.set_closed)
+        self.app.background_connection_thread(self.host, self.port, self.client_id)
+        await ready
+
+    def set_next_id(self, ready, order_id):
+        self.next_id = order_id
+        if not ready.done():
+            ready.set_result(order_id)
+
+    def set_closed(self):
+        if not self.closed.done():
+            self.closed.set_result(True)
+
+    def handle_bar(self, req_id, bar_time, open_price, high_price, low_price, close_price, volume):
+        self.on_bar(self.symbols[req_id], np.datetime64(int(bar_time), 's'),
+                    {'open_price': open_price, 'high_price': high_price, 'low_price': low_price,
+                     'close_price': close_price, 'volume': float(volume)})
+
+    async def subscribe(self, symbols):
+        self.symbols = list(symbols)
+        for req_id, symbol in enumerate(self.symbols):
+            contract = self.app.create_contract(symbol, self.sec_type)
+            self.app.reqRealTimeBars(req_id, contract, 5, self.what_to_show, True, [])
+
+    def place_order(self, order):
+        from ibapi.order import Order
+        ib_order = Order()
+        ib_order.action = order.direction
+        ib_order.orderType = order.order_type
+        ib_order.totalQuantity = order.quantity
+        order_id = self.next_id
+        self.next_id += 1
+        self.app.placeOrder(order_id, self.app.create_contract(order.symbol, self.sec_type), ib_order)
+        return order_id
+
+    def bar_done(self):
+        pass
+
+    async def wait_closed(self):
+        await self.closed
+
+    def close(self):
+        if self.app is not None:
+            self.app.disconnect()
+
+
+async def run_simulated(store, symbols, initial_capital, start_date, portfolio, strategy, interval=0.0,
+                        lockstep=True, fields=None):
+    """
+    Runs a live_engine against a simulated_broker serving store on a local
+    port and returns the engine once every bar has been handled.
+    """
+    server = simulated_broker(store, interval=interval, lockstep=lockstep)
+    port = await server.start()
+    try:
+        engine = live_engine(symbols, socket_broker(port=port), initial_capital, start_date, portfolio, strategy,
+                             fields or list(store.fields.keys()))
+        await engine.run()
+    finally:
+        server.close()
+        await server.wait_closed()
+    return engine
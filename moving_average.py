@@ -10,6 +10,8 @@ from dataeventhandler import securities_master_handler
 from executionhandler import SimulatedExecutionHandler
 from Portfolio import portfolio
 import queue
+import vectorized
+from indicators import simple_moving_average
 
 
 class MovingAverageCrossStrategy(strategy):
@@ -32,9 +34,12 @@ class MovingAverageCrossStrategy(strategy):
         self.events = events
         self.short_window = short_window
         self.long_window = long_window
+        self.price = 'close_price'
+        # The handler updates both averages once per bar for every symbol
+        self.short_key = self.bars.register_indicator(simple_moving_average(self.short_window), self.price)
+        self.long_key = self.bars.register_indicator(simple_moving_average(self.long_window), self.price)
         # Set to True if a symbol is in the market
         self.bought = self.calculate_initial_bought()
-        self.price = 'close_price'
     def calculate_initial_bought(self):
         """
         Adds keys to the bought dictionary for symbol
@@ -52,27 +57,60 @@ class MovingAverageCrossStrategy(strategy):
         event - A MarketEvent object.
         """
         if events.type == 'MARKET':
-            bars = self.bars.get_latest_bars(self.long_window)
-            # print(bars)
-            for bar in list(bars.keys()):
-                bar_date = self.bars.get_latest_bars_datetime(1)
-                if bar is not None and bars[bar] != []:
-                    short_ma = np.mean(bars[bar][0:self.short_window])
-                    long_ma = np.mean(bars[bar][0:self.long_window])
-                    dt = datetime.now()
-                    sig_dir = ""
-                    if short_ma > long_ma and self.bought[bar] == "OUT":
-                        print("LONG: %s" % bar_date)
-                        sig_dir = 'LONG'
-                        signal = signal_event(1, bar, dt, sig_dir, 1.0)
-                        self.events.put(signal)
-                        self.bought[bar] = 'LONG'
-                    elif short_ma < long_ma and self.bought[bar] == "LONG":
-                        print("SHORT: %s" % bar_date)
-                        sig_dir = 'EXIT'
-                        signal = signal_event(1, bar, dt, sig_dir, 1.0)
-                        self.events.put(signal)
-                        self.bought[bar] = 'OUT'
+            short_mas = self.bars.get_indicator_value(self.short_key)
+            long_mas = self.bars.get_indicator_value(self.long_key)
+            if short_mas is None:
+                return
+            bar_date = self.bars.get_latest_bars_datetime(1)
+            for j, bar in enumerate(self.symbols):
+                short_ma = short_mas[j]
+                long_ma = long_mas[j]
+                dt = datetime.now()
+                sig_dir = ""
+                if short_ma > long_ma and self.bought[bar] == "OUT":
+                    print("LONG: %s" % bar_date)
+                    sig_dir = 'LONG'
+                    signal = signal_event(1, bar, dt, sig_dir, 1.0)
+                    self.events.put(signal)
+                    self.bought[bar] = 'LONG'
+                elif short_ma < long_ma and self.bought[bar] == "LONG":
+                    print("SHORT: %s" % bar_date)
+                    sig_dir = 'EXIT'
+                    signal = signal_event(1, bar, dt, sig_dir, 1.0)
+                    self.events.put(signal)
+                    self.bought[bar] = 'OUT'
+
+    def calculate_vectorized_signals(self, store):
+        """
+        Generates the signals of calculate_signals for the whole history
+        at once, as a (bars x symbols) matrix of vectorized signal codes.
+        On every bar the averages cover the last short_window and long_window
+        bars, or every bar so far while fewer are available, as the
+        simple_moving_average indicators read by calculate_signals do.
+        Parameters
+        store - The bar_store loaded by the data handler.
+        """
+        prices = store.fields[self.price]
+        n = len(prices)
+        valid = ~np.isnan(prices)
+        zero = np.zeros((1, prices.shape[1]))
+        sums = np.vstack([zero, np.cumsum(np.where(valid, prices, 0.0), axis=0)])
+        gaps = np.vstack([zero, np.cumsum(~valid, axis=0)])
+        stop = np.arange(1, n + 1)
+        long_start = np.maximum(stop - self.long_window, 0)
+        short_start = np.maximum(stop - self.short_window, 0)
+
+        def window_mean(lo, hi):
+            mean = (sums[hi] - sums[lo]) / (hi - lo)[:, None]
+            return np.where(gaps[hi] - gaps[lo] > 0, np.nan, mean)
+
+        short_ma = window_mean(short_start, stop)
+        long_ma = window_mean(long_start, stop)
+        # In the market above the long average, out below it, unchanged otherwise
+        state = np.where(short_ma > long_ma, 1.0, np.where(short_ma < long_ma, 0.0, np.nan))
+        state = pd.DataFrame(state).ffill().fillna(0.0).values
+        change = np.diff(state, axis=0, prepend=0.0)
+        return np.where(change > 0, vectorized.LONG, np.where(change < 0, vectorized.EXIT, 0))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,315 @@
+import numpy as np
+import pandas as pd
+
+
+def as_array(values):
+    """
+    Returns the values of a Series or array like as a float64 array.
+    """
+    return np.asarray(values, dtype=np.float64)
+
+
+def like(values, result):
+    """
+    Returns result as a Series on the index of values when values is a Series.
+    """
+    if isinstance(values, pd.Series):
+        return pd.Series(result, index=values.index)
+    return result
+
+
+def equity_from_returns(returns):
+    """
+    Compounds period returns into an equity curve starting from 1,
+    NaN returns leaving the equity unchanged.
+    """
+    returns = as_array(returns)
+    return np.cumprod(1.0 + np.where(np.isnan(returns), 0.0, returns))
+
+
+def high_water_mark(equity):
+    """
+    Returns the running maximum of an equity curve, ignoring NaNs.
+    """
+    return like(equity, np.fmax.accumulate(as_array(equity)))
+
+
+def drawdown_durations(drawdown):
+    """
+    Returns the number of consecutive periods each point of a drawdown
+    series has spent below its high-water mark, 0 at a new high.
+    """
+    under = as_array(drawdown) > 0
+    index = np.arange(len(under))
+    last_high = np.maximum.accumulate(np.where(under, -1, index))
+    return like(drawdown, np.where(under, index - last_high, 0))
+
+
+def drawdowns(returns):
+    """
+    Computes the drawdown of the equity curve of period returns below its
+    high-water mark, as a fraction of the high-water mark, the initial
+    equity counting as the first high.
+    Returns the drawdown series, the maximum drawdown and the
+    longest drawdown duration in periods.
+    """
+    equity = equity_from_returns(returns)
+    hwm = np.maximum.accumulate(np.maximum(equity, 1.0))
+    drawdown = 1.0 - equity / hwm
+    durations = drawdown_durations(drawdown)
+    max_drawdown = drawdown.max() if len(drawdown) else 0.0
+    max_duration = int(durations.max()) if len(durations) else 0
+    return like(returns, drawdown), max_drawdown, max_duration
+
+
+def sharpe_ratio(returns, periods=252):
+    """
+    Annualised Sharpe ratio of excess period returns, ignoring NaNs.
+    NaN with fewer than two returns or no volatility.
+    """
+    returns = as_array(returns)
+    returns = returns[~np.isnan(returns)]
+    if len(returns) < 2:
+        return np.nan
+    std = np.std(returns, ddof=1)
+    if std == 0:
+        return np.nan
+    return np.sqrt(periods) * np.mean(returns) / std
+
+
+def sortino_ratio(returns, periods=252, target=0.0):
+    """
+    Annualised Sortino ratio, the mean return above target over the
+    downside deviation of the returns below target, ignoring NaNs.
+    """
+    excess = as_array(returns) - target
+    excess = excess[~np.isnan(excess)]
+    if len(excess) == 0:
+        return np.nan
+    downside = np.sqrt(np.mean(np.minimum(excess, 0.0) ** 2))
+    if downside == 0:
+        return np.nan
+    return np.sqrt(periods) * np.mean(excess) / downside
+
+
+def annualised_return(returns, periods=252):
+    """
+    Compound annual growth rate of period returns.
+    """
+    returns = as_array(returns)
+    n = np.count_nonzero(~np.isnan(returns))
+    if n == 0:
+        return np.nan
+    return equity_from_returns(returns)[-1] ** (periods / float(n)) - 1.0
+
+
+def calmar_ratio(returns, periods=252):
+    """
+    Annualised return over the maximum drawdown, NaN without a drawdown.
+    """
+    max_drawdown = drawdowns(as_array(returns))[1]
+    if max_drawdown == 0:
+        return np.nan
+    return annualised_return(returns, periods) / max_drawdown
+
+
+def value_at_risk(returns, c=0.95):
+    """
+    Historical Value-at-Risk at confidence level c, the loss, as a
+    positive fraction, exceeded by a fraction 1 - c of the returns.
+    NaN when there is no return.
+    """
+    returns = as_array(returns)
+    returns = returns[~np.isnan(returns)]
+    if len(returns) == 0:
+        return np.nan
+    return -np.quantile(returns, 1.0 - c)
+
+
+def conditional_value_at_risk(returns, c=0.95):
+    """
+    Historical Conditional Value-at-Risk, or expected shortfall, the mean
+    loss of the returns at or beyond the Value-at-Risk at level c.
+    NaN when there is no return.
+    """
+    returns = as_array(returns)
+    returns = returns[~np.isnan(returns)]
+    if len(returns) == 0:
+        return np.nan
+    tail = returns[returns <= np.quantile(returns, 1.0 - c)]
+    return -tail.mean()
+
+
+def turnover(traded, equity, periods=252):
+    """
+    Returns the turnover of every period, the value traded over the
+    equity, and the annualised mean turnover.
+    Parameters:
+    traded - The absolute value traded in each period.
+    equity - The total equity of each period.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per_period = as_array(traded) / as_array(equity)
+    valid = per_period[~np.isnan(per_period)]
+    return like(traded, per_period), periods * valid.mean() if len(valid) else np.nan
+
+
+def performance_summary(returns, traded=None, equity=None, periods=252, c=0.95):
+    """
+    Computes the full set of statistics of a returns stream in a few
+    array passes, returned as a dictionary.
+    Parameters:
+    returns - The period returns.
+    traded, equity - The value traded and the total equity of each period, for turnover.
+    periods - The number of periods in a year.
+    c - The confidence level of VaR and CVaR.
+    """
+    returns = as_array(returns)
+    drawdown, max_drawdown, max_duration = drawdowns(returns)
+    annual = annualised_return(returns, periods)
+    summary = {
+        'total_return': equity_from_returns(returns)[-1] - 1.0 if len(returns) else 0.0,
+        'annualised_return': annual,
+        'sharpe': sharpe_ratio(returns, periods),
+        'sortino': sortino_ratio(returns, periods),
+        'calmar': annual / max_drawdown if max_drawdown else np.nan,
+        'max_drawdown': max_drawdown,
+        'max_drawdown_duration': max_duration,
+        'var': value_at_risk(returns, c),
+        'cvar': conditional_value_at_risk(returns, c)
+    }
+    if traded is not None and equity is not None:
+        summary['turnover'] = turnover(traded, equity, periods)[1]
+    return summary
+
+
+class online_performance(object):
+    """
+    Running statistics of a portfolio updated in O(1) per bar, readable at
+    any point of a run without building the equity curve DataFrame: the
+    Welford mean and variance of the returns for the Sharpe ratio, the
+    high-water mark and drawdown of the equity curve, the exposure and the
+    number of fills. They follow the returns and equity curve of the
+    portfolio, so at the end of a run they match performance_summary.
+    """
+    def __init__(self, periods=252):
+        """
+        Parameters:
+        periods - The number of periods in a year.
+        """
+        self.periods = periods
+        self.bars = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.equity = 1.0
+        self.high_water_mark = 1.0
+        self.drawdown = 0.0
+        self.max_drawdown = 0.0
+        self.duration = 0
+        self.max_duration = 0
+        self.exposure = 0.0
+        self.exposure_total = 0.0
+        self.bars_in_market = 0
+        self.fills = 0
+        self.buys = 0
+        self.sells = 0
+
+    def update(self, returns, equity, gross, total):
+        """
+        Adds the bar of a portfolio.
+        Parameters:
+        returns - The return of the bar, NaN when there is none.
+        equity - The equity curve value of the bar.
+        gross - The summed absolute market value of the positions.
+        total - The total value of the portfolio.
+        """
+        self.bars += 1
+        if returns == returns:
+            self.count += 1
+            delta = returns - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (returns - self.mean)
+            self.equity = equity
+        if self.equity > self.high_water_mark:
+            self.high_water_mark = self.equity
+        self.drawdown = 1.0 - self.equity / self.high_water_mark
+        if self.drawdown > 0:
+            self.duration += 1
+        else:
+            self.duration = 0
+        self.max_drawdown = max(self.max_drawdown, self.drawdown)
+        self.max_duration = max(self.max_duration, self.duration)
+        self.exposure = gross / total if total else np.nan
+        if self.exposure == self.exposure:
+            self.exposure_total += self.exposure
+        if gross > 0:
+            self.bars_in_market += 1
+
+    def record_fill(self, fill):
+        """
+        Counts a fill.
+        """
+        self.fills += 1
+        if fill.direction == 'BUY':
+            self.buys += 1
+        elif fill.direction == 'SELL':
+            self.sells += 1
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    @property
+    def sharpe(self):
+        """
+        The annualised Sharpe ratio of the returns so far.
+        """
+        std = np.sqrt(self.variance)
+        if not std:
+            return np.nan
+        return np.sqrt(self.periods) * self.mean / std
+
+    def snapshot(self):
+        """
+        Returns the current statistics as a dictionary.
+        """
+        return {
+            'bars': self.bars,
+            'total_return': self.equity - 1.0,
+            'sharpe': self.sharpe,
+            'mean_return': self.mean,
+            'volatility': np.sqrt(self.variance),
+            'drawdown': self.drawdown,
+            'max_drawdown': self.max_drawdown,
+            'max_drawdown_duration': self.max_duration,
+            'exposure': self.exposure,
+            'mean_exposure': self.exposure_total / self.bars if self.bars else np.nan,
+            'time_in_market': self.bars_in_market / float(self.bars) if self.bars else np.nan,
+            'fills': self.fills,
+            'buys': self.buys,
+            'sells': self.sells
+        }
+
+
+class drawdown_limit(object):
+    """
+    Stop condition for Backtest and parameter_sweep ending a run once every
+    strategy session has fallen more than limit below its high-water mark,
+    or, with min_sharpe, once its running Sharpe ratio is below min_sharpe,
+    after at least min_bars bars. Instances can be sent to worker processes.
+    """
+    def __init__(self, limit, min_sharpe=None, min_bars=0):
+        self.limit = limit
+        self.min_sharpe = min_sharpe
+        self.min_bars = min_bars
+
+    def hopeless(self, stats):
+        if stats.bars < self.min_bars:
+            return False
+        if stats.max_drawdown > self.limit:
+            return True
+        return self.min_sharpe is not None and stats.sharpe < self.min_sharpe
+
+    def __call__(self, backtest):
+        return all(self.hopeless(session.portfolio.online) for session in backtest.sessions)
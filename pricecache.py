@@ -0,0 +1,133 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+class price_cache(object):
+    """
+    price_cache keeps a local copy of the securities master daily prices
+    so that repeated backtests do not read the same history from MySQL
+    again. Every symbol is a directory holding one .npy file per column,
+    which lets a cached history be memory mapped instead of read.
+    """
+    columns = ['price_date', 'open_price', 'high_price', 'low_price', 'close_price', 'volume']
+
+    def __init__(self, cache_dir):
+        """
+        Initialises the cache in cache_dir, creating it if needed.
+        Parameters:
+        cache_dir - The directory holding the cached columns.
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def symbol_dir(self, symbol):
+        """
+        Returns the directory of the cached columns for a symbol.
+        """
+        return os.path.join(self.cache_dir, symbol)
+
+    def load(self, symbol, mmap_mode='r'):
+        """
+        Returns a dictionary of the cached columns for a symbol as
+        memory mapped arrays, or None if the symbol is not cached.
+        """
+        path = self.symbol_dir(symbol)
+        if not os.path.exists(os.path.join(path, 'price_date.npy')):
+            return None
+        data = {}
+        for column in self.columns:
+            data[column] = np.load(os.path.join(path, column + '.npy'), mmap_mode=mmap_mode)
+        # A partially written refresh leaves columns of different lengths
+        if len(set(len(values) for values in data.values())) != 1:
+            return None
+        return data
+
+    def last_date(self, symbol):
+        """
+        Returns the most recent cached price_date of a symbol,
+        or None if nothing is cached.
+        """
+        data = self.load(symbol)
+        if data is None or len(data['price_date']) == 0:
+            return None
+        return pd.Timestamp(data['price_date'][-1])
+
+    def append(self, symbol, frame):
+        """
+        Appends the rows of a daily_price dataframe, which must be newer
+        than the cached ones, to the cached columns of a symbol.
+        """
+        path = self.symbol_dir(symbol)
+        os.makedirs(path, exist_ok=True)
+        cached = self.load(symbol)
+        new = {'price_date': pd.to_datetime(frame['price_date']).values.astype('datetime64[ns]')}
+        for column in self.columns[1:]:
+            new[column] = frame[column].values.astype(np.float64)
+        # price_date is written last so it always marks a complete refresh
+        for column in self.columns[1:] + self.columns[:1]:
+            values = new[column]
+            if cached is not None:
+                values = np.concatenate([cached[column], values])
+            tmp = os.path.join(path, column + '.tmp.npy')
+            np.save(tmp, values)
+            os.replace(tmp, os.path.join(path, column + '.npy'))
+
+    def load_series(self, symbol, name, length):
+        """
+        Returns the cached derived series of a symbol, or None if it is
+        missing or was computed over a history of a different length.
+        """
+        path = os.path.join(self.symbol_dir(symbol), 'derived_' + name + '.npy')
+        if not os.path.exists(path):
+            return None
+        values = np.load(path, mmap_mode='r')
+        if len(values) != length:
+            return None
+        return values
+
+    def save_series(self, symbol, name, values):
+        """
+        Stores a derived series computed over the full cached history of a symbol.
+        """
+        path = os.path.join(self.symbol_dir(symbol), 'derived_' + name + '.npy')
+        tmp = os.path.join(self.symbol_dir(symbol), 'derived_' + name + '.tmp.npy')
+        np.save(tmp, values)
+        os.replace(tmp, path)
+
+    def bounds(self, data, start_date=None, end_date=None):
+        """
+        Returns the start and stop rows of the cached columns data, as
+        returned by load, between start_date and end_date.
+        """
+        dates = data['price_date']
+        start = 0
+        stop = len(dates)
+        if start_date is not None:
+            start = int(np.searchsorted(dates, np.datetime64(pd.Timestamp(start_date)), side='left'))
+        if end_date is not None:
+            stop = int(np.searchsorted(dates, np.datetime64(pd.Timestamp(end_date)), side='right'))
+        return start, stop
+
+    def frame(self, symbol, start_date=None, end_date=None):
+        """
+        Returns the cached prices of a symbol between start_date and
+        end_date as a dataframe, or None if the symbol is not cached.
+        """
+        data = self.load(symbol)
+        if data is None:
+            return None
+        start, stop = self.bounds(data, start_date, end_date)
+        return pd.DataFrame({column: data[column][start:stop] for column in self.columns})
+
+    def invalidate(self, symbol=None):
+        """
+        Removes the cached prices of a symbol, or of every
+        symbol if none is given.
+        """
+        if symbol is None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        else:
+            shutil.rmtree(self.symbol_dir(symbol), ignore_errors=True)
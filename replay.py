@@ -0,0 +1,37 @@
+import functools
+import pandas as pd
+from backtest import Backtest
+from executionhandler import SimulatedExecutionHandler
+from journal import journal_header, journal_handler, recorded_strategy
+from Portfolio import portfolio
+
+
+def replay_journal(path, portfolio_cls=portfolio, execution_handler=SimulatedExecutionHandler, initial_capital=None,
+                   start_date=None, sessions=None, journal_path=None, profile=False):
+    """
+    Replays the signals recorded in an event journal through fresh
+    portfolios and execution handlers, re-deriving the orders, fills and
+    equity curves at the recorded prices without touching the database or
+    recomputing signals. Portfolio or commission variations can be run
+    against a fixed signal stream this way.
+    Parameters:
+    path - The journal file.
+    portfolio_cls, execution_handler - The classes used for the replay.
+    initial_capital, start_date - The portfolio settings, those recorded by default.
+    sessions - The recorded sessions to replay, all of them by default.
+    journal_path - Records the replay to a new journal, e.g. for diff_journals.
+    Returns the Backtest after the replay, with one session per replayed session.
+    """
+    header = journal_header(path)
+    if initial_capital is None:
+        initial_capital = header['initial_capital']
+    if start_date is None and header['start_date'] is not None:
+        start_date = pd.Timestamp(header['start_date']).to_pydatetime()
+    if sessions is None:
+        sessions = range(len(header['strategies']))
+    strategies = [functools.partial(recorded_strategy, session=k) for k in sessions]
+    backtest = Backtest(header['symbols'], None, None, None, None, initial_capital, 0, start_date,
+                        functools.partial(journal_handler, path=path), execution_handler, portfolio_cls, strategies,
+                        profile=profile, journal_path=journal_path)
+    backtest.run_backtest(header['price_type'])
+    return backtest
@@ -1,16 +1,17 @@
 import pandas as pd
 import numpy as np
-import mysql.connector as msc
+import dbpool
 import warnings
 import datetime
 from datetime import datetime
 from scipy.stats import norm
+import performance
+from dataeventhandler import securities_master_handler
 
 db_host = 'localhost'
 db_user = 'sec_user'
 db_pass = 'Damilare20%'
 db_name = 'securities_master'
-con = msc.connect(host=db_host, user=db_user, password=db_pass, db=db_name)
 
 warnings.filterwarnings('ignore')
 
@@ -37,16 +38,20 @@ def single_equity_sharpe(ticker, start_date, end_date, n):
                    from securities_master.‘symbol‘
                    where securities_master.‘symbol‘.‘ticker‘ = '%s'
                    """ % ticker
-    symbol = pd.read_sql_query(symbol_id, con)
     f_start_date = start_date.strftime('%Y-%m-%d')
     f_end_date = end_date.strftime('%Y-%m-%d')
-    select_str = """select distinct securities_master.‘daily_price‘.close_price
-                    from securities_master.‘daily_price‘
-                    where securities_master.‘daily_price‘.symbol_id = '%d' 
-                    and securities_master.‘daily_price‘.price_date >= '%s' and 
-                    securities_master.‘daily_price‘.price_date <= '%s'
-                """ % (symbol.iloc[0, 0], f_start_date, f_end_date)
-    symbol_price = pd.read_sql_query(select_str, con)
+    con = dbpool.get_connection(db_host, db_user, db_pass, db_name)
+    try:
+        symbol = pd.read_sql_query(symbol_id, con)
+        select_str = """select distinct securities_master.‘daily_price‘.close_price
+                        from securities_master.‘daily_price‘
+                        where securities_master.‘daily_price‘.symbol_id = '%d' 
+                        and securities_master.‘daily_price‘.price_date >= '%s' and 
+                        securities_master.‘daily_price‘.price_date <= '%s'
+                    """ % (symbol.iloc[0, 0], f_start_date, f_end_date)
+        symbol_price = pd.read_sql_query(select_str, con)
+    finally:
+        con.close()
     # Use the percentage change method to easily calculate daily returns
     symbol_price['returns'] = symbol_price['close_price'].pct_change()
     # Assume an average annual risk-free rate over the period of 5%
@@ -67,24 +72,28 @@ def market_neutral_sharpe_ratio(ticker, index_ticker, start_date, end_date, n):
                   from securities_master.‘symbol‘
                   where securities_master.‘symbol‘.‘ticker‘ = '%s'
     """ % index_ticker
-    symbol = pd.read_sql_query(symbol_id, con)
-    index = pd.read_sql_query(index_id, con)
     f_start_date = start_date.strftime('%Y-%m-%d')
     f_end_date = end_date.strftime('%Y-%m-%d')
-    select_str = """select distinct securities_master.‘daily_price‘.close_price as asset_cp,  securities_master.‘daily_price‘.price_date
-                    from securities_master.‘daily_price‘
-                    where securities_master.‘daily_price‘.symbol_id = '%d' 
-                    and securities_master.‘daily_price‘.price_date >= '%s' and 
-                    securities_master.‘daily_price‘.price_date <= '%s'
-                """ % (symbol.iloc[0, 0], f_start_date, f_end_date)
-    symbol_price = pd.read_sql_query(select_str, con)
-    select_str = """select distinct securities_master.‘daily_price‘.close_price as index_cp, securities_master.‘daily_price‘.price_date
-                    from securities_master.‘daily_price‘
-                    where securities_master.‘daily_price‘.symbol_id = '%d' 
-                    and securities_master.‘daily_price‘.price_date >= '%s' and 
-                    securities_master.‘daily_price‘.price_date <= '%s'
-                """ % (index.iloc[0, 0], f_start_date, f_end_date)
-    index_price = pd.read_sql_query(select_str, con)
+    con = dbpool.get_connection(db_host, db_user, db_pass, db_name)
+    try:
+        symbol = pd.read_sql_query(symbol_id, con)
+        index = pd.read_sql_query(index_id, con)
+        select_str = """select distinct securities_master.‘daily_price‘.close_price as asset_cp,  securities_master.‘daily_price‘.price_date
+                        from securities_master.‘daily_price‘
+                        where securities_master.‘daily_price‘.symbol_id = '%d' 
+                        and securities_master.‘daily_price‘.price_date >= '%s' and 
+                        securities_master.‘daily_price‘.price_date <= '%s'
+                    """ % (symbol.iloc[0, 0], f_start_date, f_end_date)
+        symbol_price = pd.read_sql_query(select_str, con)
+        select_str = """select distinct securities_master.‘daily_price‘.close_price as index_cp, securities_master.‘daily_price‘.price_date
+                        from securities_master.‘daily_price‘
+                        where securities_master.‘daily_price‘.symbol_id = '%d' 
+                        and securities_master.‘daily_price‘.price_date >= '%s' and 
+                        securities_master.‘daily_price‘.price_date <= '%s'
+                    """ % (index.iloc[0, 0], f_start_date, f_end_date)
+        index_price = pd.read_sql_query(select_str, con)
+    finally:
+        con.close()
     df = pd.merge(symbol_price, index_price, how='inner', on = 'price_date')
     # Calculate the percentage returns on each of the time series
     df['asset_returns'] = df['asset_cp'].pct_change()
@@ -96,15 +105,94 @@ def market_neutral_sharpe_ratio(ticker, index_ticker, start_date, end_date, n):
     return calculate_sharpe(df['net_ret'], 252)
 
 
+def load_close_prices(tickers, start_date, end_date, cache_dir=None):
+    """
+    Returns the daily close prices of every ticker as a dates x tickers
+    DataFrame, NaN where a ticker has no price, fetched with one query
+    for the symbol IDs and one ranged query for the prices, or refreshed
+    from and read out of the local price cache when cache_dir is given.
+    """
+    handler = securities_master_handler(None, list(tickers), db_host, db_user, db_pass, db_name,
+                                        start_date=start_date, end_date=end_date, cache_dir=cache_dir)
+    locations = handler.get_prices_id()
+    if cache_dir is None:
+        data = handler.query_prices(locations)
+        data['ticker'] = data['symbol_id'].map({symbol_id: ticker for ticker, symbol_id in locations.items()})
+    else:
+        frames = handler.load_frames(locations)
+        data = pd.concat([frame[['price_date', 'close_price']].assign(ticker=ticker)
+                          for ticker, frame in frames.items()], ignore_index=True)
+    data = data.drop_duplicates(['ticker', 'price_date'], keep='last')
+    prices = data.pivot(index='price_date', columns='ticker', values='close_price')
+    return prices.reindex(columns=list(tickers)).astype(np.float64)
+
+
+def previous_valid_returns(prices):
+    """
+    Returns the percentage change of each column of prices from its previous
+    non-NaN row, NaN where the price is missing, as pct_change gives on
+    the rows of a single ticker.
+    """
+    returns = prices.ffill().pct_change()
+    return returns.where(prices.notna())
+
+
+def sharpe_ratios(returns, n=252):
+    """
+    Calculates the Sharpe ratio of every column of a returns matrix in
+    one pass, ignoring NaNs, as calculate_sharpe does for one stream.
+    """
+    values = returns.values
+    return pd.Series(np.sqrt(n) * np.nanmean(values, axis=0) / np.nanstd(values, axis=0, ddof=1),
+                     index=returns.columns)
+
+
+def universe_sharpe(tickers, start_date, end_date, n=252, index_ticker=None, cache_dir=None):
+    """
+    Batch version of single_equity_sharpe and market_neutral_sharpe_ratio
+    for a whole universe. Every price, the index included, comes from one
+    ranged query, or the local cache, and every ratio is computed in a
+    single vectorized pass over the dates x tickers matrix.
+    Parameters:
+    tickers - The list of ticker symbols.
+    start_date, end_date - The date range.
+    n - The number of trading periods in a year, used for the risk-free rate.
+    index_ticker - The index hedging the market neutral strategy, if any.
+    cache_dir - The local price cache directory, if any.
+    Returns a DataFrame indexed by ticker with the sharpe and, given an
+    index, market_neutral_sharpe columns.
+    """
+    tickers = list(tickers)
+    loaded = tickers + [index_ticker] if index_ticker is not None and index_ticker not in tickers else tickers
+    prices = load_close_prices(loaded, start_date, end_date, cache_dir)
+    assets = prices[tickers]
+    # Assume an average annual risk-free rate over the period of 5%
+    excess = previous_valid_returns(assets) - 0.05 / n
+    result = pd.DataFrame({'sharpe': sharpe_ratios(excess)})
+    if index_ticker is not None:
+        # The asset and index are paired on the dates both have prices, as the inner merge does
+        index = prices[index_ticker]
+        joint = assets.notna() & index.notna().values[:, None]
+        asset_returns = previous_valid_returns(assets.where(joint))
+        index_prices = pd.DataFrame(np.where(joint, index.values[:, None], np.nan), index=assets.index,
+                                    columns=tickers)
+        index_returns = previous_valid_returns(index_prices)
+        # The net returns are (long - short)/2, since there is twice
+        # the trading capital for this strategy
+        result['market_neutral_sharpe'] = sharpe_ratios((asset_returns - index_returns) / 2.0, 252)
+    result.index.name = 'ticker'
+    return result
+
+
 def variance_covariance(p, c, mu, sigma):
     """
     Variance-Covariance calculation of daily Value-at-Risk
     using confidence level c, with mean of returns mu
     and standard deviation of returns sigma, on a portfolio
-    of value P.
+    of value p.
     """
     alpha = norm.ppf(1-c, mu, sigma)
-    return P - P * (alpha + 1)
+    return p - p * (alpha + 1)
 
 
 def calculate_drawdowns(pnl):
@@ -117,29 +205,7 @@ def calculate_drawdowns(pnl):
     pnl - A pandas Series representing period percentage returns.
 
     Returns:
-    drawdown, max_drawdown, max_duration - The drawdown series, maximum drawdown,
-    and the duration of the maximum drawdown.
+    drawdown, max_drawdown, max_duration - The drawdown series, as a fraction
+    of the high-water mark, maximum drawdown, and the duration of the maximum drawdown.
     """
-    # Calculate the cumulative returns curve
-    cumulative_returns = (1 + pnl).cumprod() - 1
-
-    # High Watermark list to track the maximum cumulative returns up to that point
-    hwm = [0]  # Initial High Watermark (before any returns)
-    # Create the drawdown and duration series
-    idx = pnl.index
-    drawdown = pd.Series(index=idx)
-    duration = pd.Series(index=idx)
-
-    # Loop over the index range to calculate drawdown and duration
-    for t in range(1, len(idx)):
-        hwm.append(max(hwm[t - 1], cumulative_returns[t]))
-        drawdown[t] = hwm[t] - cumulative_returns[t]
-        duration[t] = 0 if drawdown[t] == 0 else duration[t - 1] + 1
-
-    # Get maximum drawdown and its duration
-    max_drawdown = drawdown.max()
-    max_duration = duration.max()
-
-    return drawdown, max_drawdown, max_duration
-
-
+    return performance.drawdowns(pnl)
@@ -0,0 +1,107 @@
+import functools
+import itertools
+from multiprocessing import Pool
+import pandas as pd
+from backtest import Backtest
+from barstore import shared_bar_store, attach_store
+from dataeventhandler import securities_master_handler, event_bus
+from executionhandler import SimulatedExecutionHandler
+from Portfolio import portfolio
+
+# The shared bar_store each worker process attaches to once
+_store = None
+_blocks = None
+
+
+def expand_grid(grid):
+    """
+    Returns the list of parameter dictionaries of a grid, given either as
+    a dictionary of parameter name to a list of values, whose product is
+    taken, or directly as a list of parameter dictionaries.
+    """
+    if isinstance(grid, dict):
+        names = list(grid.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    return [dict(params) for params in grid]
+
+
+def attach_worker(descriptor):
+    """
+    Pool initializer attaching the worker to the shared price arrays.
+    """
+    global _store, _blocks
+    _store, _blocks = attach_store(descriptor)
+
+
+def worker_store():
+    """
+    Returns the shared bar_store the current worker process is attached to.
+    """
+    return _store
+
+
+def run_on_store(store, strategy, params, initial_capital, start_date, price_type='close_price',
+                 execution_handler=SimulatedExecutionHandler, portfolio_cls=portfolio, stop_condition=None):
+    """
+    Runs a backtest of a strategy with one parameter set over an already
+    loaded bar_store and returns the Backtest.
+    """
+    data_handler = functools.partial(securities_master_handler, store=store)
+    backtest = Backtest(store.symbols, None, None, None, None, initial_capital, 0, start_date, data_handler,
+                        execution_handler, portfolio_cls, functools.partial(strategy, **params),
+                        stop_condition=stop_condition)
+    backtest.run_backtest(price_type)
+    return backtest
+
+
+def run_point(task):
+    """
+    Runs one backtest of the sweep on the shared bar_store and returns
+    its parameters together with its summary statistics as numbers, so
+    the table can be sorted and filtered.
+    """
+    backtest = run_on_store(_store, *task)
+    row = dict(task[1])
+    row.update(backtest.portfolio.summary_stats())
+    row['stopped_early'] = backtest.stopped_early
+    return row
+
+
+def parameter_sweep(strategy, grid, symbols, host, user, password, name, initial_capital, start_date,
+                    price_type='close_price', end_date=None, processes=None, execution_handler=SimulatedExecutionHandler,
+                    portfolio_cls=portfolio, stop_condition=None, **handler_kwargs):
+    """
+    Backtests a strategy for every parameter set of a grid across a process
+    pool. The prices are loaded from the securities master once and placed
+    in shared memory, which every worker reads without copying.
+    Parameters:
+    strategy - The strategy class, called as strategy(bars, events, **params).
+    grid - A dictionary of parameter name to values, or a list of parameter dictionaries.
+    symbols, host, user, password, name - The universe and securities master database.
+    initial_capital - The starting capital of every backtest.
+    start_date, end_date - The date range loaded.
+    price_type - The default price field of the backtests.
+    processes - The number of worker processes, all cores by default.
+    stop_condition - A picklable callable ending hopeless runs early, see Backtest,
+    e.g. performance.drawdown_limit.
+    handler_kwargs - Extra securities_master_handler arguments, e.g. cache_dir or fill_policy.
+    Returns a DataFrame with one row of parameters and numeric summary statistics,
+    see performance.performance_summary, per backtest.
+    """
+    points = expand_grid(grid)
+    handler = securities_master_handler(event_bus(), symbols, host, user, password, name, start_date=start_date,
+                                        end_date=end_date, **handler_kwargs)
+    # Strategies register their lookbacks and derived series on the handler,
+    # so the store is loaded with every series any parameter set needs
+    for params in points:
+        strategy(handler, event_bus(), **params)
+    store = handler.pull_data(price_type)
+    shared = shared_bar_store(store)
+    try:
+        tasks = [(strategy, params, initial_capital, start_date, price_type, execution_handler, portfolio_cls,
+                  stop_condition) for params in points]
+        with Pool(processes, initializer=attach_worker, initargs=(shared.descriptor,)) as pool:
+            rows = pool.map(run_point, tasks)
+    finally:
+        shared.close()
+    return pd.DataFrame(rows)
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+from dataeventhandler import ib_commission
+
+# Signal codes of the (bars x symbols) matrices returned by
+# strategy.calculate_vectorized_signals, 0 meaning no signal
+LONG = 1
+SHORT = -1
+EXIT = 2
+
+
+class vectorized_backtest(object):
+    """
+    Runs a strategy over the whole loaded history with array operations
+    instead of per bar events. Strategies whose signals only depend on
+    past bars provide calculate_vectorized_signals, and positions, fills
+    and holdings follow the same order rules as portfolio.generate_market_order
+    and the same commission as fill_event, so the equity curve matches the
+    one of the event-driven loop.
+    """
+    def __init__(self, store, strategy, start_date, initial_capital=100000.0, price_type='close_price',
+                 quantity=100):
+        """
+        Parameters:
+        store - The bar_store loaded by the data handler.
+        strategy - A strategy implementing calculate_vectorized_signals.
+        start_date - The datetime of the initial holdings.
+        initial_capital - The starting capital in USD.
+        price_type - The field orders are filled and marked at.
+        quantity - The number of units bought or sold on an entry signal.
+        """
+        self.store = store
+        self.strategy = strategy
+        self.start_date = start_date
+        self.initial_capital = initial_capital
+        self.price_type = price_type
+        self.quantity = quantity
+
+    def calculate_positions(self, signals):
+        """
+        Returns the position held in each symbol after the fills of every bar.
+        An entry only fills from a flat position and an exit closes the
+        position, so a symbol holds the direction of the first entry after
+        its most recent exit.
+        """
+        n = signals.shape[0]
+        rows = np.arange(n)[:, None]
+        entries = (signals == LONG) | (signals == SHORT)
+        last_exit = np.maximum.accumulate(np.where(signals == EXIT, rows, -1), axis=0)
+        # next_entry[i] is the first entry at or after bar i, n if there is none
+        next_entry = np.minimum.accumulate(np.where(entries, rows, n)[::-1], axis=0)[::-1]
+        next_entry = np.vstack([next_entry, np.full((1, signals.shape[1]), n)])
+        first_entry = np.take_along_axis(next_entry, last_exit + 1, axis=0)
+        padded = np.vstack([signals, np.zeros((1, signals.shape[1]), dtype=signals.dtype)])
+        direction = np.take_along_axis(padded, first_entry, axis=0)
+        return np.where(first_entry <= rows, self.quantity * direction, 0).astype(np.float64)
+
+    def run(self):
+        """
+        Computes signals, positions, fills and holdings for the whole history.
+        """
+        prices = self.store.fields[self.price_type]
+        signals = np.asarray(self.strategy.calculate_vectorized_signals(self.store))
+        positions = self.calculate_positions(signals)
+        trades = np.diff(positions, axis=0, prepend=0.0)
+        commission = ib_commission(trades).sum(axis=1)
+        cost = np.where(trades != 0, trades * prices, 0.0).sum(axis=1)
+        cash = self.initial_capital - np.cumsum(cost + commission)
+        commission = np.cumsum(commission)
+        # Holdings are recorded before the fills of each bar, as update_time
+        # runs ahead of the orders generated on the same bar
+        held = np.vstack([np.zeros((1, positions.shape[1])), positions[:-1]])
+        values = held * prices
+        self.signals = signals
+        self.positions = positions
+        self.holdings = {
+            'values': values,
+            'commission': np.concatenate([[0.0], commission[:-1]]),
+            'cash': np.concatenate([[self.initial_capital], cash[:-1]])
+        }
+        return self.create_equity_curve_dataframe()
+
+    def create_equity_curve_dataframe(self):
+        """
+        Creates a pandas DataFrame laid out like
+        portfolio.create_equity_curve_dataframe.
+        """
+        holdings = self.holdings
+        symbols = self.store.symbols
+        index = pd.Index([self.start_date] + list(self.store.dates), name='datetime')
+        values = np.vstack([np.zeros((1, len(symbols))), holdings['values']])
+        curve = pd.DataFrame(values, index=index, columns=symbols)
+        curve['commission'] = np.concatenate([[0.0], holdings['commission']])
+        curve['cash'] = np.concatenate([[self.initial_capital], holdings['cash']])
+        curve['total'] = curve['cash'].values + values.sum(axis=1)
+        curve['returns'] = curve['cash'].pct_change()
+        curve['equity_curve'] = (1.0 + curve['returns']).cumprod()
+        return curve
+
+
+def check_parity(event_curve, vector_curve, rtol=1e-9, atol=1e-6):
+    """
+    Returns whether the equity curves of the event-driven and vectorized
+    engines match. The event-driven loop records one extra bar when the
+    data runs out, which is dropped before comparing.
+    """
+    event_curve = event_curve[~event_curve.index.duplicated(keep='first')]
+    if len(event_curve) != len(vector_curve):
+        return False
+    columns = ['commission', 'cash', 'total', 'equity_curve']
+    return bool(np.allclose(event_curve[columns].values.astype(np.float64),
+                            vector_curve[columns].values.astype(np.float64),
+                            rtol=rtol, atol=atol, equal_nan=True))
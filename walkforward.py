@@ -0,0 +1,151 @@
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from barstore import shared_bar_store
+from dataeventhandler import securities_master_handler, event_bus
+from executionhandler import SimulatedExecutionHandler
+from Portfolio import portfolio
+from sharpe import calculate_sharpe
+import sweep
+
+
+def make_folds(n, in_sample, out_of_sample, step=None, anchored=False):
+    """
+    Splits a calendar of n bars into walk-forward folds, each a tuple of
+    (in_sample_start, in_sample_stop, out_of_sample_start, out_of_sample_stop)
+    bar indices. Folds move forward by step bars, out_of_sample by default,
+    and the in-sample window grows from the first bar when anchored.
+    """
+    step = step or out_of_sample
+    folds = []
+    start = 0
+    while start + in_sample < n:
+        is_start = 0 if anchored else start
+        is_stop = start + in_sample
+        folds.append((is_start, is_stop, is_stop, min(is_stop + out_of_sample, n)))
+        start += step
+    return folds
+
+
+def sharpe_objective(backtest):
+    """
+    Default in-sample objective, the Sharpe ratio of the portfolio returns.
+    """
+    score = calculate_sharpe(backtest.portfolio.create_equity_curve_dataframe()['returns'])
+    return -np.inf if np.isnan(score) else score
+
+
+def window_start_date(store, start):
+    """
+    Returns the datetime of the initial holdings of a backtest starting
+    at bar start, the date of the bar before it when there is one.
+    """
+    return pd.Timestamp(store.dates[max(start - 1, 0)]).to_pydatetime()
+
+
+def run_fold(task):
+    """
+    Fits or optimizes a strategy on the in-sample window of a fold and
+    backtests the chosen parameters on the following out-of-sample window.
+    """
+    (k, fold, strategy, points, fit, objective, initial_capital, price_type,
+     execution_handler, portfolio_cls, warmup) = task
+    store = sweep.worker_store()
+    is_start, is_stop, oos_start, oos_stop = fold
+    in_sample = store.slice(is_start, is_stop)
+    score = np.nan
+    if fit is not None:
+        params = fit(in_sample)
+    else:
+        params = None
+        score = -np.inf
+        for point in points:
+            backtest = sweep.run_on_store(in_sample, strategy, point, initial_capital,
+                                          window_start_date(store, is_start), price_type,
+                                          execution_handler, portfolio_cls)
+            point_score = objective(backtest)
+            if params is None or point_score > score:
+                params, score = point, point_score
+    # The run starts warmup bars early so indicators and lookbacks are
+    # filled at oos_start, and only the equity from the bar before
+    # oos_start on is kept as the out-of-sample curve
+    warm_start = max(oos_start - warmup, 0)
+    backtest = sweep.run_on_store(store.slice(warm_start, oos_stop), strategy, params, initial_capital,
+                                  window_start_date(store, warm_start), price_type, execution_handler, portfolio_cls)
+    curve = backtest.portfolio.create_equity_curve_dataframe()
+    # The last bar is recorded twice when the data runs out
+    curve = curve[~curve.index.duplicated(keep='first')]
+    if warm_start < oos_start:
+        curve = curve[curve.index >= store.dates[oos_start - 1]]
+    summary = {
+        'fold': k,
+        'in_sample_start': store.dates[is_start],
+        'in_sample_end': store.dates[is_stop - 1],
+        'out_of_sample_start': store.dates[oos_start],
+        'out_of_sample_end': store.dates[oos_stop - 1],
+        'in_sample_score': score
+    }
+    summary.update(params)
+    return summary, curve['total']
+
+
+def walk_forward(strategy, symbols, host, user, password, name, initial_capital, in_sample, out_of_sample,
+                 grid=None, fit=None, objective=sharpe_objective, step=None, anchored=False, start_date=None,
+                 end_date=None, price_type='close_price', processes=None, execution_handler=SimulatedExecutionHandler,
+                 portfolio_cls=portfolio, warmup=None, **handler_kwargs):
+    """
+    Walk-forward evaluation of a strategy. The calendar of one shared
+    in-memory load is split into folds of in_sample and out_of_sample
+    bars. Each fold either fits its parameters with fit(in_sample_store)
+    or picks the parameter set of grid maximising objective(backtest) on
+    the in-sample window, then backtests the following out-of-sample
+    window. Independent folds run in parallel processes.
+    Parameters:
+    strategy - The strategy class, called as strategy(bars, events, **params).
+    symbols, host, user, password, name - The universe and securities master database.
+    initial_capital - The starting capital of every backtest.
+    in_sample, out_of_sample - The window lengths in bars.
+    grid - The parameter grid searched in-sample, as accepted by sweep.expand_grid.
+    fit - A callable returning the parameters fitted on an in-sample bar_store, used instead of grid.
+    objective - The in-sample score maximised over the grid.
+    step, anchored - How folds move forward, see make_folds.
+    warmup - The bars before each out-of-sample window the strategy is run over
+    first to fill its indicators, in_sample by default. Equity is only kept
+    from the out-of-sample window on.
+    handler_kwargs - Extra securities_master_handler arguments, e.g. cache_dir or fill_policy.
+    Returns a DataFrame of the stitched out-of-sample equity, the compounded
+    value of each fold's portfolio, and a DataFrame of one row per fold.
+    """
+    if (grid is None) == (fit is None):
+        raise ValueError("Give exactly one of grid or fit")
+    points = sweep.expand_grid(grid) if grid is not None else None
+    handler = securities_master_handler(event_bus(), symbols, host, user, password, name, start_date=start_date,
+                                        end_date=end_date, **handler_kwargs)
+    for params in points or []:
+        strategy(handler, event_bus(), **params)
+    store = handler.pull_data(price_type)
+    folds = make_folds(len(store), in_sample, out_of_sample, step, anchored)
+    if warmup is None:
+        warmup = in_sample
+    shared = shared_bar_store(store)
+    try:
+        tasks = [(k, fold, strategy, points, fit, objective, initial_capital, price_type, execution_handler,
+                  portfolio_cls, warmup) for k, fold in enumerate(folds)]
+        with Pool(processes, initializer=sweep.attach_worker, initargs=(shared.descriptor,)) as pool:
+            results = pool.map(run_fold, tasks)
+    finally:
+        shared.close()
+    # Chain the out-of-sample growth of every fold from the initial capital
+    pieces = []
+    capital = initial_capital
+    for summary, total in results:
+        growth = total / total.iloc[0]
+        piece = capital * growth.iloc[1:]
+        if len(piece):
+            capital = piece.iloc[-1]
+        pieces.append(piece)
+    stitched = pd.concat(pieces).to_frame('total')
+    stitched['returns'] = stitched['total'].pct_change()
+    stitched.iloc[0, stitched.columns.get_loc('returns')] = stitched['total'].iloc[0] / initial_capital - 1.0
+    stitched['equity_curve'] = stitched['total'] / initial_capital
+    return stitched, pd.DataFrame([summary for summary, total in results])